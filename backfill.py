@@ -0,0 +1,53 @@
+#
+# Bulk-load lifecycle of a versioned Elastic Search index served through a read alias
+#
+import logging
+from datetime import datetime
+
+logger = logging.getLogger('hyperion.meta')
+
+# settings while loading: no periodic refresh and no replica to copy every document to
+load_settings = {'index': {'refresh_interval': '-1', 'number_of_replicas': 0}}
+
+
+class IndexInTheWay(Exception):
+    """ An index holds the name the alias should take """
+
+
+def versioned_name(alias):
+    """ Fresh index name for an alias, ie sat-api-20170321084500 """
+    return '%s-%s' % (alias, datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+
+
+def finalize(es, index, replicas=1, refresh_interval='1s', timeout=3600):
+    """ Restores serving settings on a loaded index, makes its documents searchable
+    and merges it down to a single segment """
+    es.indices.put_settings(index=index, body={'index': {'refresh_interval': refresh_interval,
+                                                         'number_of_replicas': replicas}})
+    es.indices.refresh(index=index)
+    logger.info('force merging %s', index)
+    es.indices.forcemerge(index=index, max_num_segments=1, request_timeout=timeout)
+
+
+def blocks_alias(es, alias):
+    """ True when an index, rather than an alias, is named like the alias """
+    return not es.indices.exists_alias(name=alias) and es.indices.exists(index=alias)
+
+
+def swap_alias(es, alias, index, replace_index=False):
+    """ Points the alias at index alone, in one atomic update, and returns the indices it left.
+    An index named like the alias raises IndexInTheWay, unless replace_index allows deleting it
+    first; searches then fail until the alias is added, and the deleted index can not be restored """
+    previous = []
+    if es.indices.exists_alias(name=alias):
+        previous = sorted(es.indices.get_alias(name=alias).keys())
+    elif es.indices.exists(index=alias):
+        if not replace_index:
+            raise IndexInTheWay('index %s must be deleted for the alias to take its name' % alias)
+        logger.warning('deleting index %s to replace it with an alias', alias)
+        es.indices.delete(index=alias)
+
+    actions = [{'remove': {'index': i, 'alias': alias}} for i in previous if i != index]
+    actions.append({'add': {'index': index, 'alias': alias}})
+    es.indices.update_aliases(body={'actions': actions})
+    return [i for i in previous if i != index]
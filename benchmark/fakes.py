@@ -0,0 +1,239 @@
+#
+# In-process stand-ins for the IPFS HTTP API, Elastic Search, S3 and the elevation and geonames services
+#
+import json, time, hashlib, threading
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeService(object):
+    """ HTTP server on a free local port answering after `latency` seconds.
+    Subclasses implement respond(method, path, query, body) -> (status, headers, body).
+    The time spent on each request is recorded per endpoint """
+
+    name = None
+
+    def __init__(self, latency=0.0):
+        self.latency    = latency
+        self.lock       = threading.Lock()
+        self.timings    = {}
+        service         = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle_any(self):
+                started = time.time()
+                url     = urlparse(self.path)
+                length  = int(self.headers.get('Content-Length') or 0)
+                body    = self.rfile.read(length) if length else ''
+
+                time.sleep(service.latency)
+                status, headers, payload = service.respond(self.command, url.path, parse_qs(url.query), body)
+
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(payload)
+
+                service.record(service.endpoint(url.path), time.time() - started)
+
+            do_GET = do_POST = do_PUT = do_HEAD = do_DELETE = handle_any
+
+            def log_message(self, *args):
+                pass
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def endpoint(self, path):
+        return path
+
+    def record(self, endpoint, seconds):
+        with self.lock:
+            self.timings.setdefault(endpoint, []).append(seconds)
+
+    def json(self, data, status=200, headers=None):
+        h = {'Content-Type': 'application/json'}
+        h.update(headers or {})
+        return status, h, json.dumps(data)
+
+
+class FakeIpfs(FakeService):
+    """ IPFS API answering files/stat and files/ls for any path with a size and hash derived from the path """
+
+    name = 'ipfs'
+
+    def endpoint(self, path):
+        return path.replace('/api/v0/', '')
+
+    @staticmethod
+    def stat(path):
+        digest = hashlib.sha1(path).hexdigest()
+        return {'Hash': 'Qm' + digest[:44], 'Size': int(digest[:6], 16), 'CumulativeSize': 0, 'Blocks': 1,
+                'Type': 'file'}
+
+    def respond(self, method, path, query, body):
+        arg = query.get('arg', [''])[0]
+        if path.endswith('/version'):
+            return self.json({'Version': '0.4.10', 'Commit': '', 'Repo': '5', 'System': '', 'Golang': ''})
+        if path.endswith('/id'):
+            return self.json({'ID': 'QmFakeNode', 'Addresses': [], 'AgentVersion': 'fake', 'PublicKey': ''})
+        if path.endswith('/files/stat'):
+            return self.json(self.stat(arg))
+        if path.endswith('/files/ls'):
+            # a scene folder holds every band plus the archives and metadata of its level
+            level = arg.split('/')[1]
+            scene = arg.rstrip('/').split('/')[-1]
+            names = [scene + '_%s.tar.gz' % level, scene + '_%s.json' % level]
+            if level == 'L1U':
+                names += [scene + '_B%03d_L1U.TIF' % b for b in range(1, 243)]
+            entries = []
+            for name in names:
+                stat = self.stat(arg.rstrip('/') + '/' + name)
+                entries.append({'Name': name, 'Type': 0, 'Size': stat['Size'], 'Hash': stat['Hash']})
+            return self.json({'Entries': entries})
+        return self.json({'Message': 'unknown command', 'Code': 0}, status=404)
+
+
+class FakeElasticsearch(FakeService):
+    """ Elastic Search 2.x accepting index creation, mappings, single and bulk indexing.
+    Indexed documents are kept by id, with their content_hash, for get, mget and count """
+
+    name = 'es'
+
+    def __init__(self, latency=0.0):
+        super(FakeElasticsearch, self).__init__(latency)
+        self.documents = {}
+
+    def store(self, doc_id, source):
+        with self.lock:
+            self.documents[doc_id] = {'content_hash': source.get('content_hash')}
+
+    def found(self, doc_id):
+        with self.lock:
+            source = self.documents.get(doc_id)
+        if source is None:
+            return {'_id': doc_id, 'found': False}
+        return {'_id': doc_id, 'found': True, '_version': 1, '_source': source}
+
+    def endpoint(self, path):
+        parts = [p for p in path.split('/') if p]
+        if not parts:
+            return '/'
+        for p in parts:
+            if p.startswith('_'):
+                return p
+        return 'index' if len(parts) == 3 else 'indices'
+
+    def respond(self, method, path, query, body):
+        endpoint = self.endpoint(path)
+        if endpoint == '/':
+            return self.json({'version': {'number': '2.3.0'}, 'tagline': 'You Know, for Search'})
+        if endpoint == '_bulk':
+            items = []
+            lines = body.splitlines()
+            for action, source in zip(lines[::2], lines[1::2]):
+                action = json.loads(action)['index']
+                self.store(action['_id'], json.loads(source))
+                items.append({'index': dict(action, status=201, _version=1)})
+            return self.json({'took': 1, 'errors': False, 'items': items})
+        if endpoint == '_mget':
+            return self.json({'docs': [self.found(doc_id) for doc_id in json.loads(body)['ids']]})
+        if endpoint == '_count':
+            with self.lock:
+                return self.json({'count': len(self.documents)})
+        if endpoint == '_search':
+            return self.json({'hits': {'total': 0, 'hits': []}, 'aggregations': {'last': {'value': None}}})
+        if endpoint == 'index' and method in ('GET', 'HEAD'):
+            doc = self.found(path.rstrip('/').split('/')[-1])
+            return self.json(doc, status=200 if doc['found'] else 404)
+        if endpoint == 'index':
+            self.store(path.rstrip('/').split('/')[-1], json.loads(body))
+            return self.json({'created': True, '_version': 1}, status=201)
+        return self.json({'acknowledged': True})
+
+
+class FakeS3(FakeService):
+    """ Path style S3 keeping objects in memory """
+
+    name = 's3'
+
+    def __init__(self, latency=0.0):
+        super(FakeS3, self).__init__(latency)
+        self.objects = {}
+
+    def endpoint(self, path):
+        return 'object'
+
+    def respond(self, method, path, query, body):
+        if method == 'PUT':
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            with self.lock:
+                self.objects[path] = (body, etag)
+            return 200, {'ETag': etag}, ''
+
+        with self.lock:
+            stored = self.objects.get(path)
+        if stored is None:
+            return 404, {'Content-Type': 'application/xml'}, \
+                '<?xml version="1.0"?><Error><Code>NoSuchKey</Code><Message>Not found</Message></Error>'
+
+        body, etag = stored
+        return 200, {'ETag': etag, 'Content-Type': 'application/json'}, body
+
+
+class FakeElevation(FakeService):
+    """ Google Elevation API answering every location, including pipe separated batches """
+
+    name = 'elevation'
+
+    def endpoint(self, path):
+        return 'elevation'
+
+    def respond(self, method, path, query, body):
+        results = []
+        for location in query.get('locations', [''])[0].split('|'):
+            lat, lng = [float(v) for v in location.split(',')]
+            results.append({'elevation': abs(lat * 10 + lng), 'location': {'lat': lat, 'lng': lng},
+                            'resolution': 152.7})
+        return self.json({'results': results, 'status': 'OK'})
+
+
+class FakeGeonames(FakeService):
+    """ countrySubdivisionJSON and findNearbyPlaceNameJSON with fixed answers """
+
+    name = 'geonames'
+
+    def endpoint(self, path):
+        return path.strip('/')
+
+    def respond(self, method, path, query, body):
+        if 'countrySubdivision' in path:
+            return self.json({'countryName': 'United States', 'countryCode': 'US', 'adminName1': 'Nevada',
+                              'adminCode1': 'NV', 'distance': 0})
+        return self.json({'geonames': [{'toponymName': 'Place %d' % i} for i in range(10)]})
+
+
+services = [FakeIpfs, FakeElasticsearch, FakeS3, FakeElevation, FakeGeonames]
@@ -0,0 +1,148 @@
+#
+# Measures main.py throughput against local stand-ins for every external service
+#
+# python -m benchmark.run --rows 2000 --latency ipfs=0.002 --latency geonames=0.05 --output bench.json
+# python -m benchmark.run --scenario disk,s3,es -- --engine parallel --concurrency 50
+#
+import os, sys, json, time, shutil, tempfile, subprocess, click
+
+from collections import OrderedDict
+from benchmark import fakes, synth
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+default_scenarios = ['disk', 's3', 'es', 'disk,s3', 'disk,s3,es']
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def summary(timings):
+    return OrderedDict([
+        ('count', len(timings)),
+        ('p50', percentile(timings, 0.50)),
+        ('p99', percentile(timings, 0.99))
+    ])
+
+
+def environment(services, bucket='hyperion-bench'):
+    env = dict(os.environ)
+    env.update({
+        'IPFS_HOST':                '127.0.0.1',
+        'IPFS_PORT':                str(services['ipfs'].server.server_address[1]),
+        'ES_HOST':                  '127.0.0.1',
+        'ES_PORT':                  str(services['es'].server.server_address[1]),
+        'S3_ENDPOINT_URL':          services['s3'].url,
+        'BUCKETNAME':               bucket,
+        'AWS_ACCESS_KEY_ID':        'bench',
+        'AWS_SECRET_ACCESS_KEY':    'bench',
+        'AWS_DEFAULT_REGION':       'us-east-1',
+        'GOOGLE_API_KEY':           'bench',
+        'GOOGLE_ELEVATION_URL':     services['elevation'].url + '/maps/api/elevation/json',
+        'GEONAMES_URL':             services['geonames'].url
+    })
+    return env
+
+
+def run_scenario(ops, csv, scenes, latencies, extra_args):
+    """ Runs main.py once for the given writers against fresh fake services.
+    The scenario fails if main.py does, or if Elastic Search did not receive every scene """
+    services = OrderedDict((cls.name, cls(latencies.get(cls.name, 0.0)).start()) for cls in fakes.services)
+    work     = tempfile.mkdtemp(prefix='hyperion-bench-')
+
+    args = [sys.executable, os.path.join(root, 'main.py')] + ops + [
+        '--csv', csv, '--start', '01/01/01', '--end', '12/31/16',
+        '--folder', os.path.join(work, 'out'),
+        '--cache-db', os.path.join(work, 'cache.db'),
+        '--journal', os.path.join(work, 'journal.txt'),
+        '--metrics-json', os.path.join(work, 'metrics.json'),
+        '-v'
+    ] + list(extra_args)
+
+    try:
+        with open(os.path.join(work, 'main.log'), 'w') as log:
+            started = time.time()
+            status  = subprocess.call(args, cwd=root, env=environment(services), stdout=log, stderr=subprocess.STDOUT)
+            seconds = time.time() - started
+
+        result = OrderedDict([
+            ('name',        '+'.join(ops)),
+            ('exit_status', status),
+            ('seconds',     seconds),
+            ('errors',      []),
+            ('services',    OrderedDict()),
+            ('stages',      OrderedDict())
+        ])
+        if status:
+            result['errors'].append('main.py exited with status %d' % status)
+        # a run writing nothing is fast, but not a measure of anything
+        if 'es' in ops and len(services['es'].documents) != scenes:
+            result['errors'].append('%d documents indexed for %d scenes' % (len(services['es'].documents), scenes))
+        for name, service in services.items():
+            result['services'][name] = OrderedDict(
+                (endpoint, summary(timings)) for endpoint, timings in sorted(service.timings.items()))
+
+        # stage timings measured inside main.py
+        if os.path.exists(os.path.join(work, 'metrics.json')):
+            with open(os.path.join(work, 'metrics.json')) as f:
+                result['stages'] = json.load(f, object_pairs_hook=OrderedDict)['stages']
+        return result
+
+    finally:
+        for service in services.values():
+            service.stop()
+        shutil.rmtree(work, ignore_errors=True)
+
+
+@click.command(context_settings=dict(ignore_unknown_options=True))
+@click.option('--rows', default=1000, type=int, help='Scenes in the synthetic catalog. Default=1000')
+@click.option('--csv', default=None, help='Existing catalog to use instead of a synthetic one')
+@click.option('--scenario', multiple=True, help='Comma separated writers, repeatable. Default=all combinations')
+@click.option('--latency', multiple=True, metavar='SERVICE=SECONDS',
+              help='Latency added by a fake service: ipfs, es, s3, elevation or geonames')
+@click.option('--output', default=None, help='File receiving the JSON results. Default=stdout')
+@click.argument('main_args', nargs=-1, type=click.UNPROCESSED)
+def main(rows, csv, scenario, latency, output, main_args):
+    """ Runs each scenario and reports throughput and per service request timings.
+    Arguments after -- are passed to main.py """
+    latencies = {}
+    for l in latency:
+        name, _, seconds = l.partition('=')
+        latencies[name] = float(seconds)
+
+    work = tempfile.mkdtemp(prefix='hyperion-bench-')
+    try:
+        if not csv:
+            csv = os.path.join(work, 'Hyperion.csv')
+            synth.generate(csv, rows)
+
+        with open(csv) as f:
+            scenes = sum(1 for line in f) - 1
+
+        results = OrderedDict([('rows', scenes), ('latency', latencies), ('main_args', main_args), ('scenarios', [])])
+        for ops in scenario or default_scenarios:
+            result = run_scenario(ops.split(','), csv, scenes, latencies, main_args)
+            result['scenes_per_second'] = scenes / result['seconds']
+            results['scenarios'].append(result)
+            print >> sys.stderr, '%-12s %8.1f scenes/s' % (result['name'], result['scenes_per_second'])
+            for error in result['errors']:
+                print >> sys.stderr, '%-12s FAILED: %s' % (result['name'], error)
+
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    text = json.dumps(results, indent=4, separators=(',', ': '))
+    if output:
+        with open(output, 'w') as f:
+            f.write(text)
+    else:
+        print text
+
+    if any(result['errors'] for result in results['scenarios']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#
+# Synthetic Hyperion catalog for benchmarks
+#
+import csv, random
+from datetime import date, timedelta
+
+header = [
+    'SceneName', 'SceneDate', 'Year', 'DayNum', 'StartTime', 'EndTime', 'SceneDuration', 'SensorID',
+    'ReceivingStation', 'DayOrNight', 'CenterLat', 'CenterLon', 'CornerLatUpperLeft', 'CornerLonUpperLeft',
+    'CornerLatUpperRight', 'CornerLonUpperRight', 'CornerLatLowerLeft', 'CornerLonLowerLeft',
+    'CornerLatLowerRight', 'CornerLonLowerRight', 'ScenePath', 'SceneRow', 'SceneLength', 'SensorAltitude',
+    'SensorLookAngle', 'SatelliteInclination', 'SolarAzimuthAngle', 'SolarZenithAngle', 'MaxCloudCover',
+    'RequestorName', 'SceneTheme', 'LandCoverType', 'LandCoverDescription', 'RegionalLocation', 'Location',
+    'CalVal_SiteName', 'Comments', 'TapeDirName', 'BrowseImageLocation', 'AeronetStationID',
+    'AeronetStationDistance', 'PopulationPerKM2', 'SceneCenterElevation', 'AnthropogenicBiome'
+]
+
+
+def scene(day, path, row, rand):
+    """ One catalog row for a scene of the given WRS path/row acquired on day """
+    lat = rand.uniform(-60, 70)
+    lon = rand.uniform(-180, 175)
+    doy = day.timetuple().tm_yday
+    station = rand.choice(['SGS', 'AGS', 'PF1', 'PF2'])
+    name = 'EO1H%03d%03d%d%03d110K0_%s_01' % (path, row, day.year, doy, station)
+
+    return [
+        name, day.strftime('%m/%d/%y'), day.year, doy, '07:42:27', '07:42:44', 17, 'Hyperion',
+        station, 'D', lat, lon, lat + 0.49, lon + 0.08, lat + 0.48, lon + 0.15, lat - 0.47, lon - 0.15,
+        lat - 0.49, lon - 0.08, path, row, 109.6, '', rand.uniform(-10, 10), 98.11, rand.uniform(0, 360),
+        rand.uniform(20, 70), rand.randint(0, 9), 'MSO/W', '', 'Savannas', '', '', '', '', '', '',
+        '%d/%d/%d/EO1%03d%03d%d%03d110K0_%s_01.jpeg' % (path, row, day.year, path, row, day.year, doy, station),
+        '', '', 91, 428, 43
+    ]
+
+
+def generate(fname, rows, start=date(2001, 1, 1), end=date(2016, 12, 31), seed=0):
+    """ Writes a date sorted catalog of `rows` scenes spread between start and end """
+    rand = random.Random(seed)
+    span = (end - start).days + 1
+
+    with open(fname, 'wb') as f:
+        out = csv.writer(f)
+        out.writerow(header)
+        for i in range(rows):
+            day = start + timedelta(days=i * span // rows)
+            out.writerow(scene(day, rand.randint(1, 233), rand.randint(1, 248), rand))
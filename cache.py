@@ -0,0 +1,66 @@
+#
+# Persistent key/value cache stored in a local SQLite database
+#
+import json, time, sqlite3, threading
+
+
+class Cache(object):
+    """ Persistent JSON key/value store for one table of a SQLite database.
+    Entries older than ttl seconds are treated as missing. In refresh mode
+    lookups always miss, so every value gets fetched and stored again """
+
+    def __init__(self, path, table, ttl=None, refresh=False):
+        self.path       = path
+        self.table      = table
+        self.ttl        = ttl
+        self.refresh    = refresh
+        self.lock       = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT, updated REAL)' % table)
+        self.db.commit()
+
+    def get(self, key):
+        if self.refresh:
+            return None
+
+        with self.lock:
+            row = self.db.execute('SELECT value, updated FROM %s WHERE key = ?' % self.table, (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        value, updated = row
+        if self.ttl and time.time() - updated > self.ttl:
+            return None
+
+        return json.loads(value)
+
+    def set(self, key, value):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO %s (key, value, updated) VALUES (?, ?, ?)' % self.table,
+                            (key, json.dumps(value), time.time()))
+            self.db.commit()
+
+    def set_many(self, items):
+        now = time.time()
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO %s (key, value, updated) VALUES (?, ?, ?)' % self.table,
+                                [(k, json.dumps(v), now) for k, v in items])
+            self.db.commit()
+
+    def delete(self, key):
+        with self.lock:
+            self.db.execute('DELETE FROM %s WHERE key = ?' % self.table, (key,))
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM %s' % self.table)
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
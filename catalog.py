@@ -0,0 +1,204 @@
+#
+# Compact SQLite cache of the Hyperion catalog, imported from Hyperion.csv or Hyperion_2.xlsx
+#
+# python catalog.py import-catalog Hyperion_2.xlsx hyperion.db
+# python main.py disk --csv hyperion.db --path 168 --row 77 --max-cloud 10 --start 01/01/08 -v
+#
+import os, csv, sqlite3, zipfile, click
+
+from datetime import datetime, timedelta
+from xml.etree.cElementTree import iterparse
+import reader
+
+ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+# built-in spreadsheet number formats showing dates and times
+date_formats = set([14, 15, 16, 17, 22])
+time_formats = set([18, 19, 20, 21, 45, 46, 47])
+
+
+def is_catalog(fname):
+    with open(fname, 'rb') as f:
+        return f.read(16) == 'SQLite format 3\x00'
+
+
+def csv_rows(fname):
+    with open(fname, 'rb') as f:
+        for row in csv.reader(f):
+            yield row
+
+
+def cell_styles(book):
+    """ Per cell style index: 'date', 'time' or None, from the workbook number formats """
+    if 'xl/styles.xml' not in book.namelist():
+        return []
+
+    custom  = {}
+    styles  = []
+    for event, elem in iterparse(book.open('xl/styles.xml')):
+        if elem.tag == ns + 'numFmt':
+            custom[int(elem.get('numFmtId'))] = elem.get('formatCode').lower()
+        elif elem.tag == ns + 'cellXfs':
+            for xf in elem.findall(ns + 'xf'):
+                fmt  = int(xf.get('numFmtId', 0))
+                code = custom.get(fmt, '')
+                if fmt in date_formats or 'y' in code or 'd' in code:
+                    styles.append('date')
+                elif fmt in time_formats or 'h' in code or 's' in code:
+                    styles.append('time')
+                else:
+                    styles.append(None)
+    return styles
+
+
+def column_index(ref):
+    """ Zero-based column of a cell reference, ie AB12 -> 27 """
+    n = 0
+    for c in ref:
+        if not c.isalpha():
+            break
+        n = n * 26 + ord(c) - ord('A') + 1
+    return n - 1
+
+
+def xlsx_value(cell, strings, styles):
+    """ Cell value as the CSV export would spell it """
+    kind  = cell.get('t')
+    value = cell.findtext(ns + 'v')
+
+    if kind == 's':
+        return strings[int(value)]
+    if kind == 'inlineStr':
+        return ''.join(t.text or '' for t in cell.iter(ns + 't'))
+    if value is None:
+        return ''
+
+    style = styles[int(cell.get('s', 0))] if styles else None
+    if style == 'date':
+        return (datetime(1899, 12, 30) + timedelta(days=float(value))).strftime('%m/%d/%y')
+    if style == 'time':
+        seconds = int(round(float(value) * 86400)) % 86400
+        return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return value
+
+
+def xlsx_rows(fname):
+    """ Rows of the first worksheet, streamed so memory does not grow with the sheet """
+    book    = zipfile.ZipFile(fname)
+    strings = []
+    if 'xl/sharedStrings.xml' in book.namelist():
+        for event, elem in iterparse(book.open('xl/sharedStrings.xml')):
+            if elem.tag == ns + 'si':
+                strings.append(''.join(t.text or '' for t in elem.iter(ns + 't')).encode('utf-8'))
+                elem.clear()
+    styles = cell_styles(book)
+
+    for event, elem in iterparse(book.open('xl/worksheets/sheet1.xml')):
+        if elem.tag != ns + 'row':
+            continue
+        row = []
+        for cell in elem.findall(ns + 'c'):
+            i = column_index(cell.get('r'))
+            row.extend([''] * (i - len(row)))
+            row.append(xlsx_value(cell, strings, styles))
+        elem.clear()
+        yield row
+
+
+def connect(db):
+    conn = sqlite3.connect(db)
+    # same str values as reading the CSV
+    conn.text_factory = str
+    conn.execute('PRAGMA mmap_size=268435456')
+    return conn
+
+
+def import_catalog(source, db):
+    """ Loads the CSV or xlsx catalog into the scenes table of an SQLite database,
+    with values converted as csv_reader would and indexes on date, path/row and scene """
+    rows    = xlsx_rows(source) if zipfile.is_zipfile(source) else csv_rows(source)
+    header  = rows.next()
+    schema  = reader.Schema(header)
+
+    if os.path.exists(db):
+        os.remove(db)
+
+    conn    = connect(db)
+    columns = ', '.join('"%s"' % name for name in header)
+    conn.execute('CREATE TABLE scenes (scene_date INTEGER, %s)' % columns)
+    conn.execute('CREATE TABLE header (position INTEGER, name TEXT)')
+    conn.executemany('INSERT INTO header VALUES (?, ?)', enumerate(header))
+
+    insert = 'INSERT INTO scenes VALUES (?, %s)' % ', '.join('?' * len(header))
+
+    def records():
+        for row in rows:
+            if not any(row):
+                continue
+            row = (row + [''] * len(header))[:len(header)]
+            date = reader.scene_date(row, schema.date_column)
+            yield (date.toordinal(),) + schema.record(row).row
+
+    conn.executemany(insert, records())
+    conn.execute('CREATE INDEX scenes_date ON scenes (scene_date)')
+    conn.execute('CREATE INDEX scenes_path_row ON scenes ("ScenePath", "SceneRow")')
+    conn.execute('CREATE INDEX scenes_name ON scenes ("SceneName")')
+    conn.commit()
+
+    count = conn.execute('SELECT COUNT(*) FROM scenes').fetchone()[0]
+    conn.close()
+    return count
+
+
+def catalog_rows(db, start_date=None, end_date=None, path=None, row=None, max_cloud=None):
+    """ Header and rows of the catalog matching the date range and subset, in catalog order """
+    conn    = connect(db)
+    header  = [name for position, name in conn.execute('SELECT position, name FROM header ORDER BY position')]
+
+    where   = []
+    args    = []
+    if start_date:
+        where.append('scene_date >= ?')
+        args.append(start_date.toordinal())
+    if end_date:
+        where.append('scene_date <= ?')
+        args.append(end_date.toordinal())
+    if path is not None:
+        where.append('"ScenePath" = ?')
+        args.append(path)
+    if row is not None:
+        where.append('"SceneRow" = ?')
+        args.append(row)
+    if max_cloud is not None:
+        where.append('"MaxCloudCover" <= ?')
+        args.append(max_cloud)
+
+    query = 'SELECT * FROM scenes'
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += ' ORDER BY rowid'
+
+    def rows():
+        for values in conn.execute(query, args):
+            yield list(values[1:])
+        conn.close()
+
+    return header, rows()
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command('import-catalog')
+@click.argument('source')
+@click.argument('db')
+def import_catalog_command(source, db):
+    """ Converts Hyperion.csv or Hyperion_2.xlsx into an SQLite catalog usable as --csv """
+    count = import_catalog(source, db)
+    print "Imported", count, "scenes into", db
+
+
+if __name__ == '__main__':
+    cli()
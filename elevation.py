@@ -0,0 +1,189 @@
+#
+# Elevation lookups: local cache, then SRTM DEM tiles, then the Google Elevation API
+#
+import os, math, mmap, struct, logging, threading
+from throttle import Throttled, limiter
+import metrics
+import transport
+
+logger          = logging.getLogger('hyperion.meta')
+
+elevation_url   = os.getenv('GOOGLE_ELEVATION_URL', "https://maps.googleapis.com/maps/api/elevation/json")
+google_url      = elevation_url + "?locations=%s,%s&key=%s"
+
+# limits of a single request: locations, and URL length with | sent as %7C
+max_locations   = 512
+max_url_length  = 8192
+
+
+def tile_name(lat, lon):
+    """ SRTM tile name covering a point, ie N38W116 """
+    ilat = int(math.floor(lat))
+    ilon = int(math.floor(lon))
+    return "%s%02d%s%03d" % ('N' if ilat >= 0 else 'S', abs(ilat), 'E' if ilon >= 0 else 'W', abs(ilon))
+
+
+class DemTiles(object):
+    """ SRTM .hgt tiles read from a local folder. Tiles are memory-mapped on first use
+    and only the sample nearest to the requested point is read """
+
+    void = -32768
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.tiles  = {}
+        self.lock   = threading.Lock()
+
+    def tile(self, name):
+        with self.lock:
+            if name in self.tiles:
+                return self.tiles[name]
+
+            tile = None
+            for fname in (name + '.hgt', name.lower() + '.hgt'):
+                path = os.path.join(self.folder, fname)
+                if os.path.isfile(path):
+                    with open(path, 'rb') as f:
+                        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    tile = (data, int(math.sqrt(len(data) / 2)))
+                    break
+
+            self.tiles[name] = tile
+            return tile
+
+    def elevation(self, lat, lon):
+        """ Elevation in meters, or None if the point is not covered or void """
+        tile = self.tile(tile_name(lat, lon))
+        if tile is None:
+            return None
+
+        data, samples = tile
+        row = int(round((math.floor(lat) + 1 - lat) * (samples - 1)))
+        col = int(round((lon - math.floor(lon)) * (samples - 1)))
+
+        value = struct.unpack_from('>h', data, 2 * (row * samples + col))[0]
+        if value == self.void:
+            return None
+        return value
+
+
+# answers worth retrying later, the others are errors in the request
+retry_statuses = ('OVER_QUERY_LIMIT', 'OVER_DAILY_LIMIT', 'UNKNOWN_ERROR')
+
+
+def fetch(url):
+    data = transport.get_json(url)
+    if data.get('status') in retry_statuses:
+        raise Throttled(data.get('error_message', data['status']))
+    return data
+
+
+def google_elevation(lat, lon):
+    api_key     = os.environ['GOOGLE_API_KEY']
+    with metrics.timed('elevation_api'):
+        data = limiter('elevation').call(fetch, google_url % (str(lat), str(lon), api_key))
+    results     = data["results"]
+    return results[0]["elevation"]
+
+
+def google_elevations(locations):
+    """ Elevations of many "lat,lon" locations by location, in as few requests as the API limits allow.
+    The locations of a request refused, or answered with a result missing, are left out """
+    base        = elevation_url + "?key=" + os.environ['GOOGLE_API_KEY'] + "&locations="
+    elevations  = {}
+
+    start = 0
+    while start < len(locations):
+        end     = start
+        length  = len(base)
+        while end < len(locations) and end - start < max_locations:
+            length += len(locations[end]) + (3 if end > start else 0)
+            if length > max_url_length and end > start:
+                break
+            end += 1
+
+        with metrics.timed('elevation_api'):
+            data = limiter('elevation').call(fetch, base + '|'.join(locations[start:end]))
+        results = data.get("results") or []
+        if data.get("status") != 'OK' or len(results) != end - start:
+            logger.error('Elevation request for %d locations answered %s with %d results: %s', end - start,
+                         data.get("status"), len(results), data.get("error_message", ''))
+        else:
+            elevations.update(zip(locations[start:end], [r["elevation"] for r in results]))
+        start = end
+
+    return elevations
+
+
+class Elevation(object):
+    """ Elevation provider. Results are cached in memory and in an optional persistent
+    cache, keyed on lat/lon rounded to `precision` decimals, so scenes with nearly the same
+    centre share a single lookup. Local DEM tiles are tried before the Google API.
+    Both are queried at the rounded point of the key, so a key resolves to the same elevation
+    whichever scene, and whether lookup or prefetch, resolves it first """
+
+    def __init__(self, cache=None, dem=None, precision=3):
+        self.cache      = cache
+        self.dem        = dem
+        self.precision  = precision
+        self.memory     = {}
+
+    def key(self, lat, lon):
+        return "%.*f,%.*f" % (self.precision, lat, self.precision, lon)
+
+    def point(self, key):
+        lat, lon = key.split(',')
+        return float(lat), float(lon)
+
+    def lookup(self, lat, lon):
+        key         = self.key(lat, lon)
+        lat, lon    = self.point(key)
+
+        if key in self.memory:
+            metrics.count('elevation_memory_hit')
+            return self.memory[key]
+
+        elevation = self.cache.get(key) if self.cache else None
+
+        if elevation is not None:
+            metrics.count('elevation_cache_hit')
+        else:
+            if self.dem:
+                with metrics.timed('elevation_dem'):
+                    elevation = self.dem.elevation(lat, lon)
+            if elevation is None:
+                elevation = google_elevation(lat, lon)
+            if self.cache:
+                self.cache.set(key, elevation)
+
+        self.memory[key] = elevation
+        return elevation
+
+    def prefetch(self, points):
+        """ Resolves the elevations of many points ahead of their lookups, with the points
+        neither cached nor covered by the DEM sent to the Google API in batched requests """
+        missing = []
+        seen    = set()
+        for lat, lon in points:
+            key = self.key(lat, lon)
+            if key in self.memory or key in seen:
+                continue
+            seen.add(key)
+
+            elevation = self.cache.get(key) if self.cache else None
+            if elevation is None and self.dem:
+                elevation = self.dem.elevation(*self.point(key))
+                if elevation is not None and self.cache:
+                    self.cache.set(key, elevation)
+
+            if elevation is None:
+                missing.append(key)
+            else:
+                self.memory[key] = elevation
+
+        if missing:
+            elevations = google_elevations(missing)
+            self.memory.update(elevations)
+            if self.cache and elevations:
+                self.cache.set_many(elevations.items())
+        return len(missing)
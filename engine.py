@@ -0,0 +1,32 @@
+#
+# Engines running the network lookups of meta_constructor
+#
+from concurrent import futures
+
+
+class SyncEngine(object):
+    """ Runs each lookup immediately in the calling thread """
+
+    def call(self, service, fn, *args):
+        future = futures.Future()
+        future.set_result(fn(*args))
+        return future
+
+    def shutdown(self):
+        pass
+
+
+class ParallelEngine(object):
+    """ Runs lookups on one thread pool per service, sized by its concurrency limit.
+    Lookups of a scene overlap with each other and with those of the other scenes,
+    while the number of requests outstanding against a service never exceeds its limit """
+
+    def __init__(self, limits):
+        self.pools = dict((service, futures.ThreadPoolExecutor(max_workers=n)) for service, n in limits.items())
+
+    def call(self, service, fn, *args):
+        return self.pools[service].submit(fn, *args)
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=True)
@@ -0,0 +1,166 @@
+#
+# Buffered bulk indexing into Elastic Search
+#
+import json, time, logging, threading
+
+from concurrent import futures
+from elasticsearch import TransportError
+import metrics
+
+logger = logging.getLogger('hyperion.meta')
+
+# statuses worth retrying: the cluster is overloaded or temporarily unavailable
+retry_statuses = (429, 503)
+
+
+class BulkIndexer(object):
+    """ Buffers documents and sends them with bulk requests once chunk_size documents
+    or max_chunk_bytes are pending. At most max_in_flight requests are outstanding; add()
+    blocks when that limit is reached. Rejected items are retried with exponential backoff,
+    other item failures are recorded and reported by close() without stopping the run.
+    The on_done callback given with a document is called once it is indexed.
+    With skip_unchanged, the content_hash stored with the documents of a chunk is fetched first
+    and the documents given the same hash are not sent again """
+
+    def __init__(self, es, index, doc_type, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024,
+                 max_in_flight=2, max_retries=5, backoff=1.0, skip_unchanged=False):
+        self.es                 = es
+        self.index              = index
+        self.doc_type           = doc_type
+        self.chunk_size         = chunk_size
+        self.max_chunk_bytes    = max_chunk_bytes
+        self.max_retries        = max_retries
+        self.backoff            = backoff
+        self.skip_unchanged     = skip_unchanged
+
+        self.lock       = threading.Lock()
+        self.slots      = threading.BoundedSemaphore(max_in_flight)
+        self.executor   = futures.ThreadPoolExecutor(max_workers=max_in_flight)
+
+        self.pending        = []
+        self.pending_bytes  = 0
+        self.indexed        = 0
+        self.unchanged      = 0
+        self.failed         = []
+
+    def add(self, doc_id, body, on_done=None, content_hash=None):
+        action  = json.dumps({'index': {'_index': self.index, '_type': self.doc_type, '_id': doc_id}})
+        item    = (doc_id, action + '\n' + json.dumps(body) + '\n', on_done, content_hash)
+
+        with self.lock:
+            self.pending.append(item)
+            self.pending_bytes += len(item[1])
+            if len(self.pending) < self.chunk_size and self.pending_bytes < self.max_chunk_bytes:
+                return
+            chunk = self.take()
+
+        self.send(chunk)
+
+    def take(self):
+        chunk               = self.pending
+        self.pending        = []
+        self.pending_bytes  = 0
+        return chunk
+
+    def send(self, chunk):
+        self.slots.acquire()
+        future = self.executor.submit(self.send_chunk, chunk)
+        future.add_done_callback(lambda f: self.sent(f, chunk))
+
+    def sent(self, future, chunk):
+        # an error escaping send_chunk would otherwise lose the chunk without a trace
+        try:
+            if future.exception() is not None:
+                self.fail(chunk, str(future.exception()) or future.exception().__class__.__name__)
+        finally:
+            self.slots.release()
+
+    def changed(self, chunk):
+        """ Items of the chunk whose hash differs from the stored one. The others are done """
+        ids = [item[0] for item in chunk if item[3]]
+        if not ids:
+            return chunk
+
+        try:
+            with metrics.timed('es_mget'):
+                response = self.es.mget(body={'ids': ids}, index=self.index, doc_type=self.doc_type,
+                                        _source_include='content_hash')
+            stored = dict((doc['_id'], doc['_source'].get('content_hash'))
+                          for doc in response['docs'] if doc.get('found'))
+        except Exception as e:
+            logger.error('ES content hashes not read, indexing anyway: %s', e)
+            return chunk
+
+        keep = []
+        for item in chunk:
+            if item[3] and stored.get(item[0]) == item[3]:
+                with self.lock:
+                    self.unchanged += 1
+                metrics.count('es_unchanged')
+                if item[2]:
+                    item[2]()
+            else:
+                keep.append(item)
+        return keep
+
+    def send_chunk(self, chunk):
+        if self.skip_unchanged:
+            chunk = self.changed(chunk)
+
+        attempt = 0
+        while chunk:
+            retry = []
+            try:
+                body = ''.join(item[1] for item in chunk)
+                with metrics.timed('es_bulk'):
+                    response = self.es.bulk(body=body)
+                metrics.written('es_bulk', len(body))
+            except TransportError as e:
+                if e.status_code not in retry_statuses:
+                    self.fail(chunk, str(e))
+                    return
+                retry = chunk
+            except Exception as e:
+                self.fail(chunk, str(e))
+                return
+            else:
+                for item, response_item in zip(chunk, response['items']):
+                    result = response_item['index']
+                    status = result.get('status', 500)
+                    if status in retry_statuses:
+                        retry.append(item)
+                    elif status >= 300:
+                        self.fail([item], result.get('error'))
+                    else:
+                        with self.lock:
+                            self.indexed += 1
+                        if item[2]:
+                            item[2]()
+
+            if retry and attempt >= self.max_retries:
+                self.fail(retry, 'rejected after %d retries' % self.max_retries)
+                return
+            if retry:
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+            chunk = retry
+
+    def fail(self, chunk, error):
+        with self.lock:
+            for doc_id, line, on_done, content_hash in chunk:
+                logger.error('ES bulk failure %s: %s', doc_id, error)
+                self.failed.append((doc_id, error))
+
+    def flush(self):
+        with self.lock:
+            chunk = self.take()
+        if chunk:
+            self.send(chunk)
+
+    def close(self):
+        """ Sends what is left, waits for outstanding requests and reports the totals """
+        self.flush()
+        self.executor.shutdown(wait=True)
+        logger.info('ES bulk indexing done: %d indexed, %d unchanged, %d failed',
+                    self.indexed, self.unchanged, len(self.failed))
+        return self.indexed, self.unchanged, self.failed
@@ -0,0 +1,100 @@
+#
+# Offline reverse geocoder built from the GeoNames cities1000, admin1 and country dumps
+#
+import os, io, math
+from array import array
+
+earth_radius = 6371.0
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """ Great circle distance in km """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * earth_radius * math.asin(min(1.0, math.sqrt(a)))
+
+
+def read_rows(path):
+    with io.open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            yield line.rstrip('\n').split('\t')
+
+
+class GeoIndex(object):
+    """ Places from cities1000.txt kept in flat arrays and bucketed on a 1 degree grid """
+
+    def __init__(self, folder):
+        self.lats       = array('d')
+        self.lngs       = array('d')
+        self.names      = []
+        self.countries  = []
+        self.admins     = []
+        self.grid       = {}
+
+        self.country_names = {}
+        for row in read_rows(os.path.join(folder, 'countryInfo.txt')):
+            self.country_names[row[0]] = row[4]
+
+        self.admin_names = {}
+        for row in read_rows(os.path.join(folder, 'admin1CodesASCII.txt')):
+            self.admin_names[row[0]] = row[1]
+
+        for row in read_rows(os.path.join(folder, 'cities1000.txt')):
+            lat = float(row[4])
+            lng = float(row[5])
+            i   = len(self.names)
+
+            self.lats.append(lat)
+            self.lngs.append(lng)
+            self.names.append(row[1])
+            self.countries.append(row[8])
+            self.admins.append(row[8] + '.' + row[10])
+            self.grid.setdefault(self.cell(lat, lng), array('i')).append(i)
+
+    @staticmethod
+    def cell(lat, lng):
+        return int(math.floor(lat)), int(math.floor(lng))
+
+    def nearby(self, lat, lng, radius=300, max_rows=10):
+        """ Indices of places within radius km, closest first """
+        dlat    = int(math.ceil(radius / 111.0))
+        coslat  = math.cos(math.radians(min(abs(lat) + dlat, 89.9)))
+        dlng    = min(180, int(math.ceil(radius / (111.0 * coslat))))
+        clat, clng = self.cell(lat, lng)
+
+        found = []
+        # wrap around the antimeridian
+        columns = set((x + 180) % 360 - 180 for x in range(clng - dlng, clng + dlng + 1))
+
+        for y in range(clat - dlat, clat + dlat + 1):
+            for x in columns:
+                bucket = self.grid.get((y, x))
+                if not bucket:
+                    continue
+                for i in bucket:
+                    d = distance(lat, lng, self.lats[i], self.lngs[i])
+                    if d <= radius:
+                        found.append((d, i))
+
+        found.sort()
+        return [i for d, i in found[:max_rows]]
+
+    def info(self, lat, lng, radius=300, max_rows=10):
+        """ Same dict as geonames.info. Country and first-level division are taken
+        from the closest place within radius """
+        near = self.nearby(lat, lng, radius, max_rows)
+
+        countryName = countryCode = adminName1 = None
+        if near:
+            countryCode = self.countries[near[0]]
+            countryName = self.country_names.get(countryCode)
+            adminName1  = self.admin_names.get(self.admins[near[0]])
+
+        return {
+            'countryName':  countryName,
+            'countryCode':  countryCode,
+            'adminName':    adminName1,
+            'nearBy':       ', '.join(self.names[i] for i in near)
+        }
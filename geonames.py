@@ -1,22 +1,44 @@
 #
 # Geonames
 #
-import os, urllib2, json
+import os
+from geoindex import GeoIndex
+from throttle import Throttled, limiter
+import transport
+import metrics
 
+base_url = os.getenv('GEONAMES_URL', "http://api.geonames.org")
+
+# offline index, used instead of the web services once loaded
+offline = None
+
+# status codes of the answers refused for exceeding the daily, hourly or weekly credits
+limit_exceeded = (18, 19, 20)
+
+def use_offline(folder):
+	global offline
+	offline = GeoIndex(folder)
+
+def fetch(url):
+	data 		= transport.get_json(url)
+	status 		= data.get('status', {})
+	if status.get('value') in limit_exceeded:
+		raise Throttled(status.get('message'))
+	return data
 
 def countrySubdivision(lat, lng):
-	url = "http://api.geonames.org/countrySubdivisionJSON?lat="+str(lat)+"&lng="+str(lng)+"&username=cappelaere"
+	url = base_url+"/countrySubdivisionJSON?lat="+str(lat)+"&lng="+str(lng)+"&username=cappelaere"
 	#print url
-	response 	= urllib2.urlopen(url).read()
-	data 		= json.loads(response)
-	#print response
+	with metrics.timed('geonames_subdivision'):
+		data = limiter('geonames').call(fetch, url)
+	#print data
 	return data
 	
 def findNearbyPlaceName(lat, lng):
-	url = "http://api.geonames.org/findNearbyPlaceNameJSON?lat="+str(lat)+"&lng="+str(lng)+"&radius=300&style=FULL&cities=cities1000&maxRows=10&username=cappelaere"
+	url = base_url+"/findNearbyPlaceNameJSON?lat="+str(lat)+"&lng="+str(lng)+"&radius=300&style=FULL&cities=cities1000&maxRows=10&username=cappelaere"
 	#print url
-	response 	= urllib2.urlopen(url).read()
-	data 		= json.loads(response)
+	with metrics.timed('geonames_nearby'):
+		data = limiter('geonames').call(fetch, url)
 	
 	# fallback
 	# url = "http://api.geonames.org/findNearbyJSON?lat="+lat+"&lng="+lng+"&style=FULL&username=cappelaere"
@@ -25,19 +47,21 @@ def findNearbyPlaceName(lat, lng):
 	return data
 	
 def info(lat, lng):
+	if offline:
+		with metrics.timed('geonames_offline'):
+			return offline.info(lat, lng)
+	
 	countryInfo 	= countrySubdivision(lat, lng)
 	nearbyPlaceInfo = findNearbyPlaceName(lat, lng)
 	
-	if countryInfo:
-		countryName 	= countryInfo['countryName']
-		countryCode 	= countryInfo['countryCode']
-		adminName1		= countryInfo['adminName1']
-		
-	if nearbyPlaceInfo:
-		geoNames		= nearbyPlaceInfo['geonames']
-		near 			= []
-		for g in geoNames:
-			near.append( g['toponymName'] )
+	# the services answer with a status object instead of data over the ocean or on errors
+	countryName 	= countryInfo.get('countryName')
+	countryCode 	= countryInfo.get('countryCode')
+	adminName1		= countryInfo.get('adminName1')
+	
+	near 			= []
+	for g in nearbyPlaceInfo.get('geonames', []):
+		near.append( g['toponymName'] )
 		
 	geonameInfo = {
 		'countryName': 	countryName,
@@ -0,0 +1,58 @@
+#
+# Checkpoint journal of the scenes each writer has completed
+#
+import os, time, threading
+
+
+class Journal(object):
+    """ Append-only file of "<writer> <SceneName>" lines. Records are buffered and written,
+    then fsync'd, every flush_every records or flush_interval seconds, whichever comes first.
+    When resuming, the existing journal is loaded and extended, otherwise it is started over """
+
+    def __init__(self, path, resume=False, flush_every=100, flush_interval=10.0):
+        self.path           = path
+        self.flush_every    = flush_every
+        self.flush_interval = flush_interval
+        self.lock           = threading.Lock()
+        self.done           = set()
+        self.buffer         = []
+        self.last_flush     = time.time()
+
+        if resume and os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    entry = line.split()
+                    # a torn last line from a crash is ignored
+                    if len(entry) == 2:
+                        self.done.add(tuple(entry))
+
+        self.f = open(path, 'a' if resume else 'w')
+        if os.path.getsize(path) and not self.ends_with_newline():
+            self.f.write('\n')
+
+    def ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def completed(self, writer, scene):
+        return (writer, scene) in self.done
+
+    def record(self, writer, scene):
+        with self.lock:
+            self.done.add((writer, scene))
+            self.buffer.append('%s %s\n' % (writer, scene))
+            if len(self.buffer) >= self.flush_every or time.time() - self.last_flush >= self.flush_interval:
+                self.write()
+
+    def write(self):
+        self.f.write(''.join(self.buffer))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.buffer     = []
+        self.last_flush = time.time()
+
+    def close(self):
+        with self.lock:
+            self.write()
+            self.f.close()
@@ -2,13 +2,29 @@
 # Loads metadata in Elastic Search Server, S3 and Disk
 #
 
-import os, sys, json, logging, boto3, click, urllib2, math
+import os, sys, json, time, logging, boto3, click, math, socket, hashlib
 
-from copy import copy
 from collections import OrderedDict
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
+from threading import Lock
+from botocore.exceptions import BotoCoreError, ClientError
 from elasticsearch import Elasticsearch, RequestError
-from reader import csv_reader
+from reader import csv_reader, Pipeline
+from cache import Cache
+from elevation import Elevation, DemTiles
+from es_bulk import BulkIndexer
+from s3_upload import Uploader
+from s3_catalog import Catalogs
+import s3_catalog
+from shards import ShardWriter
+from engine import SyncEngine, ParallelEngine
+from journal import Journal
+import metrics
+import sharding
+import throttle
+import transport
+import products
+import backfill
 import geonames
 
 sys.path.append('../hyperion-l1u')
@@ -17,20 +33,42 @@ import ipfsapi
 
 logger      = logging.getLogger('hyperion.meta')
 bucket_name = os.getenv('BUCKETNAME', 'hyperion-meta')
-s3          = boto3.resource('s3')
+s3_endpoint = os.getenv('S3_ENDPOINT_URL')
+s3          = boto3.resource('s3', endpoint_url=s3_endpoint)
 aws_s3_dir	= os.path.join("https://s3.amazonaws.com", bucket_name)
+state_key   = 'L1U/_state/last_updated.json'
 
+es          = None
 es_index    = 'sat-api'
+es_alias    = 'sat-api'
 es_type     = 'hyperion'
 host_url    = "http://hyperion-api.herokuapp.com"
 ipfs_api    = None
+ipfs_cache  = None
+elevation_provider = None
+bulk_indexer = None
+uploader    = None
+shard_writer = None
+catalogs    = None
+catalog_entries = None
+engine      = SyncEngine()
+journal     = None
+product_report = None
+skip_unchanged = False
+disk_manifest  = None
+disk_counts    = OrderedDict([('written', 0), ('unchanged', 0)])
+disk_lock      = Lock()
 
-def create_index(index_name, doc_type):
+latest_written  = None
+latest_lock     = Lock()
+
+def create_index(index_name, doc_type, settings=None):
     
     body = {
         doc_type: {
             'properties': {
                 'scene_id': {'type': 'string', 'index': 'not_analyzed'},
+                'content_hash': {'type': 'string', 'index': 'not_analyzed'},
                 'satellite_name': {'type': 'string'},
                 'cloud_coverage': {'type': 'float'},
                 'date': {'type': 'date'},
@@ -42,7 +80,7 @@ def create_index(index_name, doc_type):
         }
     }
     
-    es.indices.create(index=index_name, ignore=400)
+    es.indices.create(index=index_name, body={'settings': settings} if settings else None, ignore=400)
     
     es.indices.put_mapping(
         doc_type=doc_type,
@@ -50,6 +88,44 @@ def create_index(index_name, doc_type):
         index=index_name
     )
 
+def ipfs_listing(directory):
+    """ Size and Hash of every entry of an IPFS MFS directory, by name, from a single long
+    listing served from the local cache when available. A missing directory lists nothing """
+    if ipfs_cache:
+        listing = ipfs_cache.get(directory)
+        if listing is not None:
+            metrics.count('ipfs_cache_hit')
+            return listing
+    
+    try:
+        with metrics.timed('ipfs_ls'):
+            result = ipfs_api.files_ls(directory, opts={'l': True})
+    except ipfsapi.exceptions.ErrorResponse as e:
+        logger.error('IPFS directory %s not listed: %s', directory, e)
+        return {}
+    
+    listing = {}
+    for entry in result.get('Entries') or []:
+        listing[entry['Name']] = {'Size': entry['Size'], 'Hash': entry['Hash']}
+    
+    if ipfs_cache:
+        ipfs_cache.set(directory, listing)
+    return listing
+
+
+def forget_listing(directory):
+    """ Drops the cached listing of a directory found incomplete, so the next run lists it again """
+    if ipfs_cache:
+        ipfs_cache.delete(directory)
+
+
+class MissingFiles(Exception):
+    """ Files a scene document can not do without are not in IPFS """
+
+
+class Rejected(Exception):
+    """ Elastic Search refused a scene document """
+
 def convert_date(value):
     dt      = value.split(' ')[0]
     arr     = dt.split('/')
@@ -64,10 +140,31 @@ def convert_SceneName(value):
     scene = value.split('_')
     return scene[0]
 
+def scene_centre(metadata):
+    """ Centre of the scene footprint, as the mean of its corners """
+    pclat = float(metadata.get('CornerLatUpperLeft')) + float(metadata.get('CornerLatUpperRight')) + float(metadata.get('CornerLatLowerRight')) + float(metadata.get('CornerLatLowerLeft'))
+    pclat /= 4.0
+
+    pclon = float(metadata.get('CornerLonUpperLeft')) + float(metadata.get('CornerLonUpperRight')) + float(metadata.get('CornerLonLowerRight')) + float(metadata.get('CornerLonLowerLeft'))
+    pclon /= 4.0
+    return pclat, pclon
+
+
+def prefetch_elevations(records):
+    """ Resolves the elevations of a batch of scenes in multi-location requests. On failure
+    the scenes fall back to their own lookups """
+    try:
+        with metrics.timed('elevation_prefetch'):
+            fetched = elevation_provider.prefetch([scene_centre(r) for r in records])
+        logger.info('prefetched %d elevations for %d scenes', fetched, len(records))
+    except Exception as e:
+        logger.error('Elevation prefetch failed: %s', e)
+
+
 def meta_constructor(metadata):
     global ipfs_api
     
-    internal_meta = copy(metadata)
+    internal_meta = metadata.copy()
     
     data_geometry = {
         "type": "polygon",
@@ -91,6 +188,18 @@ def meta_constructor(metadata):
     year 		    = scene_id[10:14]
     doy			    = scene_id[14:17]
     
+    lat= float(metadata.get('CenterLat'))
+    lon= float(metadata.get('CenterLon'))
+    
+    # Check centerlat, centerlon and elevation
+    pclat, pclon = scene_centre(metadata)
+    
+    print "Getting lat, lon", lat, lon, pclat, pclon
+    
+    # start every lookup before waiting on any of them, so the parallel engine overlaps them
+    elevation_call  = engine.call('elevation', elevation_provider.lookup, pclat, pclon)
+    geonames_call   = engine.call('geonames', geonames.info, lat, lon)
+    
     if 'sources' in metadata:
         sources = metadata['sources']
     else:
@@ -98,43 +207,62 @@ def meta_constructor(metadata):
         ipfs_l1t_dir	= os.path.join("/L1T", year, doy, scene_id)
         ipfs_l1s_dir	= os.path.join("/L1S", year, doy, scene_id)
 
-        l1u_geotiffs = []
+        # one listing per scene directory gives the size and hash of all its files
+        ipfs_l1u_call           = engine.call('ipfs', ipfs_listing, ipfs_l1u_dir)
+        ipfs_l1s_call           = engine.call('ipfs', ipfs_listing, ipfs_l1s_dir)
+        ipfs_l1t_call           = engine.call('ipfs', ipfs_listing, ipfs_l1t_dir)
+        
+        l1u_listing             = ipfs_l1u_call.result()
+        l1s_listing             = ipfs_l1s_call.result()
+        l1t_listing             = ipfs_l1t_call.result()
+        
+        required = [
+            (ipfs_l1u_dir, l1u_listing, scene_id+"_L1U.tar.gz"),
+            (ipfs_l1s_dir, l1s_listing, scene_id+"_L1S.tar.gz"),
+            (ipfs_l1t_dir, l1t_listing, scene_id+"_L1T.tar.gz"),
+            (ipfs_l1s_dir, l1s_listing, scene_id+"_L1S.json"),
+            (ipfs_l1t_dir, l1t_listing, scene_id+"_L1T.json")
+        ]
+        missing = [name for directory, listing, name in required if name not in listing]
+        if missing:
+            # the files may still be on their way to IPFS
+            for directory in set(directory for directory, listing, name in required if name not in listing):
+                forget_listing(directory)
+            raise MissingFiles('%s: %s not in IPFS' % (scene_id, ', '.join(missing)))
+        
+        l1u_geotiffs    = []
+        missing_bands   = []
         for b in range(242):
-            if config.bbl[b]:
-                basefilename	= scene_id+"_B%03d_L1U.TIF" % (b+1)
-                ipfs_l1u_path   = os.path.join(ipfs_l1u_dir,basefilename)
+            if not config.bbl[b]:
+                continue
             
-                ipfs_l1u_meta 	= ipfs_api.files_stat(ipfs_l1u_path)
+            basefilename	= scene_id+"_B%03d_L1U.TIF" % (b+1)
+            ipfs_l1u_meta 	= l1u_listing.get(basefilename)
+            if ipfs_l1u_meta is None:
+                missing_bands.append(b+1)
+                continue
             
-                filename 		= os.path.join(aws_s3_dir, "L1U", year, doy, scene_id, basefilename)
-                l1u_geotiffs.append( {
-                    "band_%03d"%(b+1) : {
-                        "size": 	ipfs_l1u_meta['Size'],
-                        "href" : 	filename,
-                        "torrent": 	filename+"?torrent",
-                        "ipfs": 	"/ipfs/" +ipfs_l1u_meta['Hash']
-                    }
-                })
-    
-        basefilename 	        = scene_id+"_L1U.tar.gz"
-        ipfs_l1u_path           = os.path.join(ipfs_l1u_dir,basefilename)
-        ipfs_l1u_meta 	        = ipfs_api.files_stat(ipfs_l1u_path)
-    
-        basefilename 	        = scene_id+"_L1S.tar.gz"
-        ipfs_l1s_path           = os.path.join(ipfs_l1s_dir,basefilename)
-        ipfs_l1s_meta 	        = ipfs_api.files_stat(ipfs_l1s_path)
-
-        basefilename 	        = scene_id+"_L1T.tar.gz"
-        ipfs_l1t_path           = os.path.join(ipfs_l1t_dir,basefilename)
-        ipfs_l1t_meta 	        = ipfs_api.files_stat(ipfs_l1t_path)
-     
-        l1s_meta_filename 	    = scene_id+"_L1S.json"
-        ipfs_l1s_meta_path      = os.path.join(ipfs_l1s_dir,l1s_meta_filename)
-        ipfs_l1s_meta_meta      = ipfs_api.files_stat(ipfs_l1s_meta_path)
+            filename 		= os.path.join(aws_s3_dir, "L1U", year, doy, scene_id, basefilename)
+            l1u_geotiffs.append( {
+                "band_%03d"%(b+1) : {
+                    "size": 	ipfs_l1u_meta['Size'],
+                    "href" : 	filename,
+                    "torrent": 	filename+"?torrent",
+                    "ipfs": 	"/ipfs/" +ipfs_l1u_meta['Hash']
+                }
+            })
 
-        l1t_meta_filename 	    = scene_id+"_L1T.json"
-        ipfs_l1t_meta_path      = os.path.join(ipfs_l1t_dir,l1t_meta_filename)
-        ipfs_l1t_meta_meta      = ipfs_api.files_stat(ipfs_l1t_meta_path)
+        if missing_bands:
+            logger.error('%s: %d bands not in IPFS: %s', scene_id, len(missing_bands),
+                         ', '.join('B%03d' % b for b in missing_bands))
+            metrics.count('ipfs_missing_bands', len(missing_bands))
+            forget_listing(ipfs_l1u_dir)
+        
+        ipfs_l1u_meta 	        = l1u_listing[scene_id+"_L1U.tar.gz"]
+        ipfs_l1s_meta 	        = l1s_listing[scene_id+"_L1S.tar.gz"]
+        ipfs_l1t_meta 	        = l1t_listing[scene_id+"_L1T.tar.gz"]
+        ipfs_l1s_meta_meta      = l1s_listing[scene_id+"_L1S.json"]
+        ipfs_l1t_meta_meta      = l1t_listing[scene_id+"_L1T.json"]
 
         # reset to L1U
         basefilename 	        = scene_id+"_L1U.tar.gz"
@@ -201,27 +329,7 @@ def meta_constructor(metadata):
             }
         }
     
-    lat= float(metadata.get('CenterLat'))
-    lon= float(metadata.get('CenterLon'))
-
-    
-    # Check centerlat, centerlon and elevation
-    pclat = float(metadata.get('CornerLatUpperLeft')) + float(metadata.get('CornerLatUpperRight')) + float(metadata.get('CornerLatLowerRight')) + float(metadata.get('CornerLatLowerLeft'))
-    pclat /= 4.0
-
-    pclon = float(metadata.get('CornerLonUpperLeft')) + float(metadata.get('CornerLonUpperRight')) + float(metadata.get('CornerLonLowerRight')) + float(metadata.get('CornerLonLowerLeft'))
-    pclon /= 4.0
-    
-    print "Getting lat, lon", lat, lon, pclat, pclon
-    YOUR_API_KEY    = os.environ['GOOGLE_API_KEY']
-    print "GKEy", YOUR_API_KEY
-    google_url      = "https://maps.googleapis.com/maps/api/elevation/json?locations=" + str(pclat) +","+ str(pclon) + "&key="+YOUR_API_KEY
-    print "Gogole url", google_url
-   
-    el_response 	= urllib2.urlopen(google_url).read()
-    el_data 		= json.loads(el_response)
-    results         = el_data["results"]
-    elevation       = results[0]["elevation"]
+    elevation       = elevation_call.result()
     
     #print results
     #print results[0]["elevation"]
@@ -257,7 +365,7 @@ def meta_constructor(metadata):
     for r in removed:
         del internal_meta[r]
     
-    geonamesInfo = geonames.info(lat, lon)
+    geonamesInfo = geonames_call.result()
     #print "geonamesInfo", geonamesInfo
      
     body = OrderedDict([
@@ -286,45 +394,142 @@ def meta_constructor(metadata):
     return body
 
 
-def elasticsearch_updater(product_dir, metadata):
+class SceneDocument(object):
+    """ A scene document built once and shared by every writer """
+
+    def __init__(self, body, key=None):
+        self.body       = body
+        self.key        = key
+        self._json      = None
+        self._hash      = None
+
+    def to_json(self):
+        """ Compact JSON encoding of the document, computed on first use """
+        if self._json is None:
+            self._json = json.dumps(self.body)
+        return self._json
+
+    def content_hash(self):
+        """ SHA-1 of the document encoded with sorted keys and no whitespace, so the same
+        metadata always gives the same hash whatever the key order of the build """
+        if self._hash is None:
+            text        = json.dumps(self.body, sort_keys=True, separators=(',', ':'))
+            self._hash  = hashlib.sha1(text).hexdigest()
+        return self._hash
+
+    def without(self, *keys):
+        """ Returns a shallow copy of the document without the given top-level keys """
+        view = OrderedDict(self.body)
+        for k in keys:
+            view.pop(k, None)
+        return view
+
+
+def build_document(metadata):
+    with metrics.timed('build'):
+        return SceneDocument(meta_constructor(metadata), metadata.get('SceneName'))
+
+
+def completed(writer, document):
+    """ Records in the journal that a writer is done with a scene """
+    if journal and document.key:
+        journal.record(writer, document.key)
+    if product_report:
+        product_report.completed(writer, document)
+
+
+def es_unchanged(document):
+    """ True when the indexed document already carries the content hash of this one """
+    with metrics.timed('es_get'):
+        stored = es.get(index=es_index, doc_type=es_type, id=document.body['scene_id'],
+                        _source_include='content_hash', ignore=404)
+    return stored.get('found') and stored['_source'].get('content_hash') == document.content_hash()
+
+
+def elasticsearch_updater(product_dir, document):
     try:
-        body = meta_constructor(metadata)
+        body = document.without('actions', 'sources')
+        body['content_hash'] = document.content_hash()
         
         print 'Pushing to Elasticsearch', es_index, es_type, body['scene_id']
-        del body['actions']
-        del body['sources']
+        
+        if bulk_indexer:
+            bulk_indexer.add(body['scene_id'], body, lambda: completed('es', document), body['content_hash'])
+            return
+        
+        if skip_unchanged and es_unchanged(document):
+            metrics.count('es_unchanged')
+            completed('es', document)
+            return
         
         try:
-            es.index(index=es_index, doc_type=es_type, id=body['scene_id'], body=body)
+            with metrics.timed('es'):
+                es.index(index=es_index, doc_type=es_type, id=body['scene_id'], body=body)
+            completed('es', document)
         except RequestError as e:
-            print "ES RequestError", e
-            print  body['data_geometry']
-            body['data_geometry'] = None
-            es.index(index=es_index, doc_type=es_type, id=body['scene_id'], body=body)
-            sys.exit(-1)
+            logger.error('data_geometry of %s: %s', body['scene_id'], json.dumps(body['data_geometry']))
+            raise Rejected('%s rejected by Elastic Search: %s' % (body['scene_id'], e))
     
     except Exception as e:
+        # raised to the pipeline, which reports the scene as failed
         logger.error('Unhandled error occured while writing to elasticsearch')
         logger.error('Details: %s' % e.__str__())
         logger.error('Error on line {}'.format(sys.exc_info()[-1].tb_lineno))
-        sys.exit(-1)
+        raise
+
+
+def disk_unchanged(path, key, document):
+    """ True when path exists and the manifest records the document's content hash as written under key """
+    unchanged = skip_unchanged and os.path.exists(path) and disk_manifest.get(key) == document.content_hash()
+    with disk_lock:
+        disk_counts['unchanged' if unchanged else 'written'] += 1
+    if unchanged:
+        metrics.count('disk_unchanged')
+        completed('disk', document)
+    return unchanged
 
 
-def file_writer(product_dir, metadata):
+def file_writer(product_dir, document):
+    body = document.body
+    
+    if shard_writer:
+        scene_id    = body['scene_id']
+        path        = shard_writer.shard_path(scene_id[10:14], scene_id[14:17])
+        key         = path + '#' + scene_id
+        if disk_unchanged(path, key, document):
+            return
+        
+        def done():
+            disk_manifest.set(key, document.content_hash())
+            completed('disk', document)
+        
+        with metrics.timed('disk'):
+            text = document.to_json()
+            shard_writer.add(scene_id[10:14], scene_id[14:17], scene_id, text, done)
+        metrics.written('disk', len(text))
+        return
+    
     print "file_writer", product_dir
     
-    body = meta_constructor(metadata)
+    path = os.path.join(product_dir, body['scene_id'] + '.json')
+    if disk_unchanged(path, path, document):
+        return
     
     if not os.path.exists(product_dir):
         os.makedirs(product_dir)
     
-    f = open(os.path.join(product_dir, body['scene_id'] + '.json'), 'w')
-    f.write(json.dumps(body, indent=4, separators=(',',': ')))
-    logger.info('saving to disk at %s' % product_dir)
-    f.close()
+    with metrics.timed('disk'):
+        text = json.dumps(body, indent=4, separators=(',',': '))
+        f = open(path, 'w')
+        f.write(text)
+        logger.info('saving to disk at %s' % product_dir)
+        f.close()
+    disk_manifest.set(path, document.content_hash())
+    metrics.written('disk', len(text))
+    completed('disk', document)
 
 
-def s3_writer(product_dir, metadata):
+def s3_writer(product_dir, document):
     # make sure product_dir doesn't start with slash (/) or dot (.)
     if product_dir.startswith('.'):
         product_dir = product_dir[1:]
@@ -332,55 +537,181 @@ def s3_writer(product_dir, metadata):
     if product_dir.startswith('/'):
         product_dir = product_dir[1:]
     
-    body        = meta_constructor(metadata)
+    body        = document.body
     scene_id 	= body['scene_id']
     year 		= scene_id[10:14]
     doy			= scene_id[14:17]
     name        = scene_id.split("_")[0]
     
     key = os.path.join('L1U', year, doy, name, body['scene_id'] + '.json')
-    s3.Object(bucket_name, key).put(Body=json.dumps(body), ACL='public-read', ContentType='application/json')
     
-    logger.info('saving to s3 at %s %s', bucket_name, key)
+    def done():
+        completed('s3', document)
+        note_written(body['date'])
+        if catalogs:
+            catalogs.add(year, doy, s3_catalog.entry(body, os.path.join(aws_s3_dir, key)))
+    
+    uploader.put(key, document.to_json(), done, content_hash=document.content_hash())
+
 
+def note_written(datestr):
+    """ Raises the high-water mark of scene dates written to S3 in this run """
+    global latest_written
+    with latest_lock:
+        if latest_written is None or datestr > latest_written:
+            latest_written = datestr
 
-def last_updated(today):
-    """ Gets the latest time a product added to Elasticsearch """
+
+def stored_last_updated():
+    """ Date of the S3 state object, or None if there is none yet """
+    try:
+        state = json.loads(s3.Object(bucket_name, state_key).get()['Body'].read())
+        return datetime.strptime(state['date'], '%Y-%m-%d').date()
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+    return None
+
+
+def save_last_updated(attempts=3):
+    """ Stores the high-water mark in the S3 state object, unless a later date is already there.
+    The object is read back after writing it, and written again if a concurrent run, ie another
+    shard, replaced it with an earlier date in between """
+    if latest_written is None:
+        return
     
-    bucket = s3.Bucket(bucket_name)
+    for attempt in range(attempts + 1):
+        previous = stored_last_updated()
+        if previous and previous.isoformat() >= latest_written:
+            return
+        if attempt == attempts:
+            break
+        
+        s3.Object(bucket_name, state_key).put(Body=json.dumps({'date': latest_written}),
+                                              ContentType='application/json')
+        logger.info('last updated %s saved to s3 at %s %s', latest_written, bucket_name, state_key)
     
-    start_day = today.day
-    start_month = today.month
+    logger.error('last updated %s could not be kept in s3 at %s %s', latest_written, bucket_name, state_key)
+
+
+def last_updated(ops):
+    """ Gets the latest scene date published, from the S3 state object maintained by s3_writer
+    when writing to S3, or else from a max aggregation on Elasticsearch. Returns None if neither knows """
     
-    yr_counter = 0
-    while True:
-        m_counter = 0
-        year = today.year - yr_counter
-        if year < 2015:
-            break
-        while True:
-            month = start_month - m_counter
-            if month == 0:
-                start_month = 12
-                break
-            d_counter = 0
-            while True:
-                day = start_day - d_counter
-                if day == 0:
-                    start_day = 31
-                    break
-                path = os.path.join(str(year), str(month), str(day))
-                logger.info('checking %s' % path)
-                objs = bucket.objects.filter(Prefix=path).limit(1)
-                if list(objs):
-                    return date(year, month, day)
-                d_counter += 1
-            m_counter += 1
-        yr_counter += 1
+    if 's3' in ops:
+        try:
+            latest = stored_last_updated()
+            if latest:
+                return latest
+        except (BotoCoreError, ClientError) as e:
+            logger.error('last updated date not read from s3: %s', e)
+    
+    if es:
+        result = es.search(index=es_alias, doc_type=es_type,
+                           body={'size': 0, 'aggs': {'last': {'max': {'field': 'date'}}}})
+        latest = result['aggregations']['last'].get('value_as_string')
+        if latest:
+            return datetime.strptime(latest[:10], '%Y-%m-%d').date()
     
     return None
 
 
+def publish_product(path, writers, product_dir):
+    """ Loads a product JSON file and hands its document to the writers """
+    try:
+        with open(path) as data:
+            json_data = json.load(data)
+        logger.info('processing %s' % json_data['scene_id'])
+        document = build_document(json_data)
+        
+        product_report.started(path, document, [op for op, w in writers])
+        for op, w in writers:
+            w(product_dir, document)
+    except Exception as e:
+        product_report.failed(path, e)
+        raise
+
+
+def publish_backfill(stats, totals, replicas, replace_index):
+    """ Puts a completed backfill index in service behind the read alias.
+    An index missing scenes, or holding fewer documents than scenes processed, is left out of service """
+    failures = stats['failed'] + stats['timed_out'] + stats['deferred'] + totals.get('es', {}).get('failed', 0)
+    if failures:
+        logger.error('Backfill index %s left out of service after %d failures', es_index, failures)
+        return False
+    
+    es.indices.refresh(index=es_index)
+    documents = es.count(index=es_index, doc_type=es_type)['count']
+    if not stats['processed'] or documents < stats['processed']:
+        logger.error('Backfill index %s left out of service: %d documents for %d scenes processed',
+                     es_index, documents, stats['processed'])
+        return False
+    
+    backfill.finalize(es, es_index, replicas)
+    try:
+        previous = backfill.swap_alias(es, es_alias, es_index, replace_index)
+    except backfill.IndexInTheWay as e:
+        logger.error('Backfill index %s left out of service: %s', es_index, e)
+        return False
+    logger.info('%s now serves %s', es_alias, es_index)
+    if previous:
+        logger.info('Indices no longer served, to delete once the backfill is checked: %s', ', '.join(previous))
+    return True
+
+
+def write_shard_catalogs(path, processes, workers):
+    """ Merges the catalog entries saved by the shards of a run into the S3 catalogs, in one pass """
+    shard_uploader  = Uploader(bucket_name, max_workers=workers, endpoint_url=s3_endpoint)
+    shard_catalogs  = Catalogs(shard_uploader, max_workers=workers)
+    for i in range(processes):
+        part = sharding.part_path(path, i, processes)
+        if os.path.isfile(part):
+            shard_catalogs.read(part)
+    written = shard_catalogs.close()
+    shard_uploader.close()
+    return written
+
+
+def service_values(values, defaults):
+    """ Defaults overridden by SERVICE=N option values """
+    result = OrderedDict(defaults)
+    for value in values:
+        service, _, n = value.partition('=')
+        if service not in result or not n.isdigit():
+            raise click.UsageError('Invalid service value (%s)' % value)
+        result[service] = int(n)
+    return result
+
+
+def finish():
+    """ Flushes the writers that buffer their output and returns their totals """
+    totals = OrderedDict()
+    if bulk_indexer:
+        indexed, unchanged, failed = bulk_indexer.close()
+        totals['es'] = OrderedDict([('indexed', indexed), ('unchanged', unchanged), ('failed', len(failed))])
+    if uploader:
+        uploaded, skipped, failed = uploader.close()
+        written = OrderedDict()
+        if catalogs and catalog_entries:
+            written['catalog_entries'] = catalogs.save(catalog_entries)
+        elif catalogs:
+            # after the scene uploads, whose completion adds the entries, and before counting failures
+            written['catalogs'] = catalogs.close()
+        totals['s3'] = OrderedDict([('uploaded', len(uploaded)), ('skipped', len(skipped)), ('failed', len(failed))])
+        totals['s3'].update(written)
+        save_last_updated()
+    if shard_writer:
+        shard_writer.close()
+    if disk_manifest:
+        totals['disk'] = disk_counts
+    engine.shutdown()
+    throttle.save()
+    if journal:
+        journal.close()
+    metrics.report()
+    return totals
+
+
 @click.command()
 @click.argument('ops', metavar='<operations: choices: s3 | es | disk>', nargs=-1)
 @click.option('--start', default=None, help='Start Date. Format: MM/DD/YY')
@@ -388,27 +719,191 @@ def last_updated(today):
 #@click.option('--es-host', default='localhost', help='Elasticsearch host address')
 #@click.option('--es-port', default=9200, type=int, help='Elasticsearch port number')
 @click.option('--csv', default='.', help='csv file to read')
+@click.option('--csv-index', is_flag=True,
+              help='Seek to the rows within --start/--end using a date index saved next to the csv file')
+@click.option('--path', 'scene_path', default=None, type=int, help='Only this WRS path')
+@click.option('--row', 'scene_row', default=None, type=int, help='Only this WRS row')
+@click.option('--max-cloud', default=None, type=float, help='Maximum cloud cover')
 @click.option('--folder', default='.', help='Destination folder if is written to disk')
+@click.option('--disk-layout', default='files', type=click.Choice(['files', 'year', 'day']),
+              help='files writes one indented JSON file per scene, year and day append compact documents '
+                   'to one NDJSON shard per year or per day. Default=files')
+@click.option('--disk-gzip', is_flag=True, help='Compress NDJSON shards as a series of gzip blocks')
 @click.option('--download', is_flag=True,
               help='Sets the updater to download the metadata file first instead of streaming it')
 @click.option('--download-folder', default=None,
               help='The folder to save the downloaded metadata to. Defaults to a temp folder')
 @click.option('-v', '--verbose', is_flag=True)
 @click.option('--concurrency', default=20, type=int, help='Process concurrency. Default=20')
-@click.option('--product', default=None, help='Uploadproduct metadata')
+@click.option('--row-timeout', default=0, type=int,
+              help='Seconds after which a scene is reported as timed out, also used as network timeout. Default=0 (none)')
+@click.option('--engine', 'engine_name', default='sync', type=click.Choice(['sync', 'parallel']),
+              help='sync runs the IPFS, elevation and geonames lookups of a scene one after the other, '
+                   'parallel overlaps them on bounded per-service thread pools. Default=sync')
+@click.option('--service-limit', multiple=True, metavar='SERVICE=N',
+              help='Concurrent requests per service for the parallel engine. Default=ipfs=32, elevation=4, geonames=4')
+@click.option('--rate-limit', multiple=True, metavar='SERVICE=N',
+              help='Requests per second to geonames or elevation. Default=elevation=50')
+@click.option('--hourly-quota', multiple=True, metavar='SERVICE=N',
+              help='Requests per hour to geonames or elevation. Default=geonames=1000')
+@click.option('--daily-quota', multiple=True, metavar='SERVICE=N',
+              help='Requests per day to geonames or elevation. Default=geonames=20000')
+@click.option('--retry-rounds', default=3, type=int,
+              help='Times the scenes deferred while a service is throttled or down are tried again. Default=3')
+@click.option('--retry-delay', default=60, type=int, help='Seconds before deferred scenes are tried again. Default=60')
+@click.option('--shard', default=None, metavar='I/N', help='Process only shard I of N of the scenes, ie 0/4')
+@click.option('--shard-key', default='hash', type=click.Choice(['hash', 'date']),
+              help='hash splits scenes on their name, date keeps the scenes of a day together. Default=hash')
+@click.option('--processes', default=0, type=int,
+              help='Runs N local processes, one per shard, then merges their reports. Default=0 (single process)')
+@click.option('--report', 'report_path', default=None,
+              help='JSON report of the run. Default=hyperion-report.json when sharded')
+@click.option('--product', multiple=True,
+              help='Product metadata to upload: a JSON file, a directory searched for JSON files, or a glob pattern. '
+                   'Repeatable')
+@click.option('--journal', 'journal_path', default='hyperion-journal.txt',
+              help='Checkpoint file of the scenes each writer completed. Default=hyperion-journal.txt')
+@click.option('--resume', is_flag=True, help='Skip the scenes the journal records as completed')
+@click.option('--es-bulk-size', default=500, type=int,
+              help='Documents per Elastic Search bulk request, 0 to index one at a time. Default=500')
+@click.option('--es-bulk-bytes', default=10, type=int, help='Maximum size of a bulk request in MB. Default=10')
+@click.option('--es-in-flight', default=2, type=int, help='Concurrent bulk requests. Default=2')
+@click.option('--backfill', 'backfill_mode', is_flag=True,
+              help='Index into a new versioned index loaded without refresh or replicas, then point the sat-api '
+                   'alias at it if every scene was indexed')
+@click.option('--backfill-index', default=None,
+              help='Name of the backfill index, ie to resume one. Default=sat-api-<UTC timestamp>')
+@click.option('--es-replicas', default=1, type=int, help='Replicas of a backfill index once loaded. Default=1')
+@click.option('--replace-index', is_flag=True,
+              help='Let a backfill delete the sat-api index, not an alias yet, so the alias can take its name. '
+                   'Searches fail until the alias is added')
+@click.option('--skip-unchanged/--always-write', 'skip_writes', default=True,
+              help='Skip the ES, S3 and disk writes of documents whose content hash matches the one stored with '
+                   'the copy already written. Default=skip')
+@click.option('--s3-workers', default=16, type=int, help='Concurrent S3 uploads. Default=16')
+@click.option('--s3-catalog/--no-s3-catalog', 's3_catalogs', default=True,
+              help='Maintain per-day and per-year catalogs of the scenes written to S3. Default=on')
+@click.option('--catalog-entries', 'catalog_entries_path', default=None,
+              help='Save the catalog entries of a shard to this file, for --processes to write the catalogs once')
+@click.option('--metrics-json', default=None, help='File receiving per-stage timings and counters as JSON at exit')
+@click.option('--metrics-prom', default=None, help='Prometheus text file refreshed with the same metrics during the run')
+@click.option('--metrics-interval', default=15, type=int, help='Seconds between Prometheus file updates. Default=15')
+@click.option('--cache-db', default=os.getenv('HYPERION_CACHE_DB', 'hyperion-cache.db'),
+              help='Local SQLite cache of IPFS directory listings and elevations. Default=hyperion-cache.db')
+@click.option('--ipfs-cache-ttl', default=0, type=int,
+              help='Seconds before a cached IPFS directory listing expires. Default=0 (never)')
+@click.option('--refresh-ipfs', is_flag=True, help='Ignore cached IPFS directory listings and fetch them again')
+@click.option('--dem-folder', default=os.getenv('HYPERION_DEM'),
+              help='Folder of SRTM .hgt tiles used for elevation before the Google API')
+@click.option('--geonames-dir', default=os.getenv('GEONAMES_DIR'),
+              help='Folder with the GeoNames cities1000, admin1CodesASCII and countryInfo dumps for offline lookups')
+@click.option('--elevation-precision', default=3, type=int,
+              help='Decimals of lat/lon used to key cached elevations. Default=3')
+@click.option('--elevation-batch', default=512, type=int,
+              help='Scenes whose elevations are requested together ahead of processing, 0 for one request '
+                   'per scene. Default=512')
 
 # python main.py disk s3 es --csv Hyperion_3.csv --folder ../data/L1U_metadata --start 01/01/03 -v
 # python main.py disk --csv Hyperion_3.csv --folder ../data/L1U_metadata --start 01/01/03 -v
 # python main.py es --product /Volumes/LaCie/EO1/DESTRIPE/2013/228/EO1H0110282013228110T3_DESTRIPE_B10_B11/EO1H0110282013228110T3_DESTRIPE_B10_B11.json -v
+# python main.py es s3 --product /Volumes/LaCie/EO1/DESTRIPE --product '/Volumes/LaCie/EO1/L1G/201?' --report products.json -v
 
-def main(ops, csv, start, end, folder, download, download_folder, verbose, concurrency, product):
-    global ipfs_api
+def main(ops, csv, csv_index, start, end, scene_path, scene_row, max_cloud, folder, disk_layout, disk_gzip,
+         download, download_folder, verbose, concurrency, row_timeout, engine_name, service_limit,
+         rate_limit, hourly_quota, daily_quota, retry_rounds, retry_delay,
+         shard, shard_key, processes, report_path, product, journal_path, resume,
+         es_bulk_size, es_bulk_bytes, es_in_flight, backfill_mode, backfill_index, es_replicas, replace_index,
+         skip_writes, s3_workers, s3_catalogs, catalog_entries_path, metrics_json, metrics_prom, metrics_interval,
+         cache_db, ipfs_cache_ttl, refresh_ipfs, dem_folder, geonames_dir, elevation_precision, elevation_batch):
+    global ipfs_api, ipfs_cache, elevation_provider, bulk_indexer, uploader, shard_writer, engine, journal, \
+        product_report, es_index, catalogs, disk_manifest, skip_unchanged, catalog_entries
     
     if not ops:
         raise click.UsageError('No Argument provided. Use --help if you need help')
     
-    ipfs_api 	= ipfsapi.connect('127.0.0.1', 5001)
+    if backfill_mode and (shard or processes or product):
+        raise click.UsageError('--backfill loads one index from a single process, without --shard, --processes '
+                               'or --product')
+    
+    if product and (shard or processes):
+        raise click.UsageError('--product publishes its files from a single process, without --shard or --processes')
+    
+    if backfill_mode and resume and not backfill_index:
+        raise click.UsageError('--resume of a backfill needs the --backfill-index being resumed')
+    
+    write_catalogs = 's3' in ops and s3_catalogs
+    if shard and write_catalogs and not catalog_entries_path:
+        raise click.UsageError('Shards can not update the S3 catalogs concurrently: use --processes '
+                               'or --no-s3-catalog')
+    
+    if processes:
+        if shard:
+            raise click.UsageError('--processes and --shard can not be combined')
+        argv = sharding.without_option(sys.argv, '--processes')
+        if write_catalogs:
+            catalog_entries_path = catalog_entries_path or 'hyperion-catalog-entries.ndjson'
+            argv = sharding.without_option(argv, '--catalog-entries') + ['--catalog-entries', catalog_entries_path]
+        statuses = sharding.launch(argv, processes)
+        report_path = report_path or 'hyperion-report.json'
+        merged = sharding.merge_files([sharding.part_path(report_path, i, processes) for i in range(processes)],
+                                      report_path, processes)
+        if write_catalogs:
+            merged['writers'].setdefault('s3', OrderedDict())['catalogs'] = \
+                write_shard_catalogs(catalog_entries_path, processes, s3_workers)
+            sharding.write_json(report_path, merged)
+        print json.dumps(merged, indent=4, separators=(',', ': '))
+        sys.exit(max(statuses))
+    
+    part = None
+    if shard:
+        # every shard keeps its own journal, metrics, report and disk shard files
+        index, count    = sharding.parse(shard)
+        part            = sharding.part_name(index, count)
+        journal_path    = sharding.part_path(journal_path, index, count)
+        report_path     = sharding.part_path(report_path or 'hyperion-report.json', index, count)
+        if metrics_json:
+            metrics_json = sharding.part_path(metrics_json, index, count)
+        if metrics_prom:
+            metrics_prom = sharding.part_path(metrics_prom, index, count)
+        if catalog_entries_path:
+            catalog_entries_path = sharding.part_path(catalog_entries_path, index, count)
+    
+    metrics.configure(metrics_json, metrics_prom, metrics_interval)
+    
+    if row_timeout:
+        socket.setdefaulttimeout(row_timeout)
+    
+    # keep one pooled connection per thread that may call geonames or elevation at once
+    connections = concurrency
+    if engine_name == 'parallel':
+        limits = service_values(service_limit, OrderedDict([('ipfs', 32), ('elevation', 4), ('geonames', 4)]))
+        engine = ParallelEngine(limits)
+        connections = max(limits['elevation'], limits['geonames'])
+    transport.configure(connections, read_timeout=row_timeout or 30)
+    
+    rates       = service_values(rate_limit, {'geonames': None, 'elevation': 50})
+    per_hour    = service_values(hourly_quota, {'geonames': 1000, 'elevation': None})
+    per_day     = service_values(daily_quota, {'geonames': 20000, 'elevation': None})
+    # the shards of a run share the services' quotas, each gets an equal part
+    shares      = count if shard else 1
+    share       = lambda n: float(n) / shares if n else None
+    quotas      = Cache(cache_db, 'quotas')
+    for service in ('geonames', 'elevation'):
+        throttle.configure(service, rate=share(rates[service]), per_hour=share(per_hour[service]),
+                           per_day=share(per_day[service]), state=quotas,
+                           key=service + ('.' + part if part else ''))
+    
+    ipfs_api 	= ipfsapi.connect(os.getenv('IPFS_HOST', '127.0.0.1'), int(os.getenv('IPFS_PORT', 5001)))
     ipfs_id 	= ipfs_api.id()
+    ipfs_cache  = Cache(cache_db, 'ipfs_ls', ttl=ipfs_cache_ttl or None, refresh=refresh_ipfs)
+    
+    elevation_provider = Elevation(cache=Cache(cache_db, 'elevation'),
+                                   dem=DemTiles(dem_folder) if dem_folder else None,
+                                   precision=elevation_precision)
+    
+    if geonames_dir:
+        logger.info("Loading geonames from %s", geonames_dir)
+        geonames.use_offline(geonames_dir)
     #print "*** ipfs_id", ipfs_id
     #sys.exit(-1)
     
@@ -421,7 +916,7 @@ def main(ops, csv, start, end, folder, download, download_folder, verbose, concu
     writers = []
     for op in ops:
         if op in accepted_args.keys():
-            writers.append(accepted_args[op])
+            writers.append((op, accepted_args[op]))
         else:
             raise click.UsageError('Operation (%s) is not supported' % op)
     
@@ -439,6 +934,8 @@ def main(ops, csv, start, end, folder, download, download_folder, verbose, concu
     
     print "folder", folder, "csv", csv
     
+    skip_unchanged = skip_writes
+    
     if 'es' in ops:
         global es
         
@@ -451,32 +948,98 @@ def main(ops, csv, start, end, folder, download, download_folder, verbose, concu
             'port': es_port
         }])
         
-        create_index(es_index, es_type)
+        if backfill_mode:
+            if not replace_index and backfill.blocks_alias(es, es_alias):
+                raise click.UsageError('%s is an index, not an alias: --replace-index lets the backfill delete it '
+                                       'once loaded' % es_alias)
+            es_index = backfill_index or backfill.versioned_name(es_alias)
+            logger.info("Backfilling into %s", es_index)
+            create_index(es_index, es_type, settings=backfill.load_settings)
+        else:
+            create_index(es_index, es_type)
+        
+        if es_bulk_size > 0:
+            # a backfill index starts empty, so there is nothing to compare against
+            bulk_indexer = BulkIndexer(es, es_index, es_type, chunk_size=es_bulk_size,
+                                       max_chunk_bytes=es_bulk_bytes * 1024 * 1024, max_in_flight=es_in_flight,
+                                       skip_unchanged=skip_unchanged and not backfill_mode)
+    
+    if backfill_mode and 'es' in ops:
+        # a backfill journal records the scenes of its own index, not those of the index being served
+        root, ext       = os.path.splitext(journal_path)
+        journal_path    = '%s-%s%s' % (root, es_index, ext)
+    
+    if 's3' in ops:
+        uploader = Uploader(bucket_name, max_workers=s3_workers, endpoint_url=s3_endpoint,
+                            skip_unchanged=skip_unchanged)
+        if s3_catalogs:
+            catalogs        = Catalogs(uploader, max_workers=s3_workers)
+            catalog_entries = catalog_entries_path
     
-    if not start and not end:
-        delta = timedelta(days=3)
-        start = date.today() - delta
+    if 'disk' in ops:
+        disk_manifest = Cache(cache_db, 'disk_manifest')
+    
+    if 'disk' in ops and disk_layout != 'files':
+        shard_writer = ShardWriter(folder, granularity=disk_layout, compress=disk_gzip, part=part)
+    
+    if not start and not end and not product and not backfill_mode:
+        # pick up from the latest scene date already published, a backfill loads the whole catalog
+        start = last_updated(ops)
+        if start:
+            logger.info('Last updated %s', start)
+        else:
+            start = date.today() - timedelta(days=3)
         start = '{0}/{1}/{2}'.format(start.month, start.day,start.year-2000)
     
-    # Simple product upload
+    # Product upload, concurrency files at a time
     if product:
-        print "product", product
-        if not os.path.exists(product):
-            print "Product does not exist", product
-            
-        with open(product) as data:
-            json_data = json.load(data)
-            data.close()
-        #print json_data
-        logger.info('processing %s' % json_data['scene_id'])
-        for w in writers:
-            w(download_folder, json_data)
+        print "product", ', '.join(product)
+        product_report  = products.Report()
+        pipeline        = Pipeline(concurrency, timeout=row_timeout or None)
+        try:
+            for path in products.discover(product):
+                product_report.add(path)
+                pipeline.submit(path, publish_product, path, writers, download_folder or folder)
+            pipeline.join()
+        finally:
+            finish()
+        
+        summary = product_report.summary()
+        for result in summary['results']:
+            if result['status'] == 'failed':
+                logger.error('%s failed: %s', result['path'], result['error'])
+        if report_path:
+            sharding.write_json(report_path, summary)
         
-        print "Done"
-        sys.exit(0)
+        print "Done: %(published)d published, %(failed)d failed" % summary['counts']
+        sys.exit(1 if summary['counts']['failed'] else 0)
         
-    csv_reader(csv, folder, writers, start_date=start, end_date=end, download=download, download_path=download_folder,
-               num_worker_threads=concurrency)
+    journal = Journal(journal_path, resume=resume)
+    started = time.time()
+    
+    try:
+        stats = csv_reader(csv, folder, writers, start_date=start, end_date=end, download=download,
+                           download_path=download_folder, num_worker_threads=concurrency, builder=build_document,
+                           row_timeout=row_timeout or None, journal=journal, use_index=csv_index,
+                           subset={'path': scene_path, 'row': scene_row, 'max_cloud': max_cloud},
+                           shard=(index, count, shard_key) if shard else None,
+                           retries=retry_rounds, retry_delay=retry_delay,
+                           prefetch=prefetch_elevations if elevation_batch else None, prefetch_size=elevation_batch)
+    finally:
+        # send what the writers still buffer, even when interrupted
+        totals = finish()
+    
+    if report_path:
+        sharding.write_json(report_path, OrderedDict([
+            ('shard',   shard or '0/1'),
+            ('key',     shard_key),
+            ('seconds', time.time() - started),
+            ('stats',   stats),
+            ('writers', totals)
+        ]))
+    
+    if backfill_mode and 'es' in ops and not publish_backfill(stats, totals, es_replicas, replace_index):
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,181 @@
+#
+# Per-stage latency histograms and counters of the metadata pipeline
+#
+import os, json, time, threading
+from collections import OrderedDict
+
+# histogram bucket upper bounds, in seconds
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+enabled     = False
+json_path   = None
+prom_path   = None
+lock        = threading.Lock()
+stages      = {}
+counters    = {}
+
+
+class Stage(object):
+    """ Latency histogram with call, error and byte counts of one stage """
+
+    def __init__(self):
+        self.counts     = [0] * len(buckets)
+        self.calls      = 0
+        self.errors     = 0
+        self.total      = 0.0
+        self.max        = 0.0
+        self.bytes      = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.calls += 1
+        self.total += seconds
+        self.max    = max(self.max, seconds)
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the p-th fraction of the calls """
+        rank = p * self.calls
+        seen = 0
+        for bound, count in zip(buckets, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return 0.0
+
+    def summary(self):
+        return OrderedDict([
+            ('calls',   self.calls),
+            ('errors',  self.errors),
+            ('bytes',   self.bytes),
+            ('total',   round(self.total, 6)),
+            ('mean',    round(self.total / self.calls, 6) if self.calls else 0.0),
+            ('p50',     self.percentile(0.50)),
+            ('p90',     self.percentile(0.90)),
+            ('p99',     self.percentile(0.99)),
+            ('max',     round(self.max, 6))
+        ])
+
+
+def stage(name):
+    with lock:
+        if name not in stages:
+            stages[name] = Stage()
+        return stages[name]
+
+
+class Timer(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, kind, value, tb):
+        elapsed = time.time() - self.started
+        s = stage(self.name)
+        with lock:
+            s.observe(elapsed)
+            if kind is not None:
+                s.errors += 1
+
+
+class NoTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, tb):
+        pass
+
+no_timer = NoTimer()
+
+
+def timed(name):
+    """ Context manager recording the duration of a stage, and an error if it raises """
+    return Timer(name) if enabled else no_timer
+
+
+def count(name, n=1):
+    """ Adds n to an event counter, ie cache hits """
+    if enabled:
+        with lock:
+            counters[name] = counters.get(name, 0) + n
+
+
+def written(name, n):
+    """ Adds n bytes written to a stage """
+    if enabled:
+        s = stage(name)
+        with lock:
+            s.bytes += n
+
+
+def summary():
+    with lock:
+        return OrderedDict([
+            ('stages',      OrderedDict((name, stages[name].summary()) for name in sorted(stages))),
+            ('counters',    OrderedDict(sorted(counters.items())))
+        ])
+
+
+def write_json(path):
+    with open(path, 'w') as f:
+        json.dump(summary(), f, indent=4, separators=(',', ': '))
+
+
+def prometheus():
+    """ Stages in the Prometheus text exposition format """
+    lines = []
+    with lock:
+        for name in sorted(stages):
+            s = stages[name]
+            label = 'stage="%s"' % name
+            seen = 0
+            for bound, n in zip(buckets, s.counts):
+                seen += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('hyperion_stage_seconds_bucket{%s,le="%s"} %d' % (label, le, seen))
+            lines.append('hyperion_stage_seconds_sum{%s} %f' % (label, s.total))
+            lines.append('hyperion_stage_seconds_count{%s} %d' % (label, s.calls))
+            lines.append('hyperion_stage_errors_total{%s} %d' % (label, s.errors))
+            lines.append('hyperion_stage_bytes_total{%s} %d' % (label, s.bytes))
+        for name in sorted(counters):
+            lines.append('hyperion_events_total{event="%s"} %d' % (name, counters[name]))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path):
+    # written aside then renamed, so the collector never reads a partial file
+    with open(path + '.tmp', 'w') as f:
+        f.write(prometheus())
+    os.rename(path + '.tmp', path)
+
+
+def configure(json_file=None, prom_file=None, interval=15):
+    """ Turns collection on when an output file is given. The Prometheus file
+    is rewritten every interval seconds from a daemon thread """
+    global enabled, json_path, prom_path
+    json_path   = json_file
+    prom_path   = prom_file
+    enabled     = bool(json_file or prom_file)
+
+    if prom_file:
+        def loop():
+            while True:
+                time.sleep(interval)
+                write_prometheus(prom_file)
+
+        thread = threading.Thread(target=loop)
+        thread.daemon = True
+        thread.start()
+
+
+def report():
+    """ Writes the final metrics to the configured files """
+    if json_path:
+        write_json(json_path)
+    if prom_path:
+        write_prometheus(prom_path)
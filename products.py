@@ -0,0 +1,82 @@
+#
+# Pre-built product JSON files, ie DESTRIPE outputs, found under directories or glob patterns
+#
+import os, glob, threading
+from collections import OrderedDict
+
+
+def discover(patterns):
+    """ JSON files named by, or found under, the paths, directories and glob patterns given.
+    Each file is yielded once, in sorted order; a path that does not exist, or a pattern matching
+    nothing, is yielded as is, so that it is reported as failed """
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else []
+        matches = matches or [pattern]
+        for match in matches:
+            if os.path.isdir(match):
+                paths = []
+                for root, dirs, files in os.walk(match):
+                    dirs.sort()
+                    paths.extend(os.path.join(root, name) for name in sorted(files) if name.endswith('.json'))
+            else:
+                paths = [match]
+
+            for path in paths:
+                if path not in seen:
+                    seen.add(path)
+                    yield path
+
+
+class Report(object):
+    """ Outcome of each product file. A file is published once every writer completed its
+    document, and failed if it could not be loaded, built or written. Files still waiting on a
+    writer when the run ends, ie rejected by a bulk request, are reported as failed too """
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.files      = OrderedDict()
+        self.documents  = {}
+
+    def add(self, path):
+        with self.lock:
+            self.files[path] = OrderedDict([('status', 'loading'), ('scene_id', None), ('error', None)])
+
+    def started(self, path, document, writers):
+        with self.lock:
+            entry = self.files[path]
+            entry['status']     = 'writing'
+            entry['scene_id']   = document.body.get('scene_id')
+            entry['pending']    = set(writers)
+            self.documents[id(document)] = (path, document)
+
+    def completed(self, writer, document):
+        with self.lock:
+            item = self.documents.get(id(document))
+            if item is None:
+                return
+            entry = self.files[item[0]]
+            entry['pending'].discard(writer)
+            if not entry['pending'] and entry['status'] == 'writing':
+                entry['status'] = 'published'
+                del self.documents[id(document)]
+
+    def failed(self, path, error):
+        with self.lock:
+            entry = self.files[path]
+            entry['status'] = 'failed'
+            entry['error']  = str(error) or error.__class__.__name__
+
+    def summary(self):
+        with self.lock:
+            files   = []
+            counts  = OrderedDict([('published', 0), ('failed', 0)])
+            for path, entry in self.files.items():
+                if entry['status'] != 'published' and entry['status'] != 'failed':
+                    pending         = sorted(entry.get('pending', []))
+                    entry['error']  = 'not completed by %s' % ', '.join(pending) if pending else 'not loaded'
+                    entry['status'] = 'failed'
+                counts[entry['status']] += 1
+                files.append(OrderedDict([('path', path), ('status', entry['status']),
+                                          ('scene_id', entry['scene_id']), ('error', entry['error'])]))
+            return OrderedDict([('files', len(files)), ('counts', counts), ('results', files)])
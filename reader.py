@@ -1,5 +1,6 @@
 import os
 import time
+import json
 import logging
 import requests
 import csv
@@ -9,7 +10,11 @@ from concurrent import futures
 from datetime import datetime
 from homura import download as fetch
 from tempfile import mkdtemp
-from collections import OrderedDict
+from collections import OrderedDict, Mapping
+import catalog
+import metrics
+import throttle
+import sharding
 
 logger = logging.getLogger('hyperion.meta')
 
@@ -22,6 +27,183 @@ def convert_date(value):
     return datetime.strptime(value, '%m/%d/%y').date()
 
 
+# columns of the Hyperion CSV that never hold numbers, all others are read as floats
+text_columns = ('SceneName', 'SceneDate', 'SensorID', 'ReceivingStation', 'DayOrNight', 'RequestorName',
+                'BrowseImageLocation')
+
+
+def text(value):
+    return value
+
+
+def subset_filters(header, path=None, row=None, max_cloud=None):
+    """ (column, test) pairs selecting the CSV rows of a subset, as catalog_rows does in SQL.
+    Blank or non numeric cells never match """
+    filters = []
+    for name, value, test in (('ScenePath', path, lambda v, x: v == x),
+                              ('SceneRow', row, lambda v, x: v == x),
+                              ('MaxCloudCover', max_cloud, lambda v, x: v <= x)):
+        if value is not None:
+            filters.append((header.index(name), lambda cell, value=value, test=test:
+                            isinstance(number(cell), float) and test(number(cell), value)))
+    return filters
+
+
+def number(value):
+    # blank or free text cells stay as they are
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+class Record(object):
+    """ Read-only row of the catalog, backed by a tuple of converted values.
+    Subclasses made by Schema share the column names and positions of one header.
+    The mapping methods are implemented here rather than inherited from Mapping, whose
+    Python 2 classes define no __slots__ and would give every record a __dict__ """
+
+    __slots__   = ('row',)
+    names       = ()
+    columns     = {}
+
+    def __init__(self, row):
+        self.row = row
+
+    def __getitem__(self, key):
+        try:
+            return self.row[self.columns[key]]
+        except IndexError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.columns and self.columns[key] < len(self.row)
+
+    def __iter__(self):
+        return iter(self.names[:len(self.row)])
+
+    def __len__(self):
+        return len(self.row)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self.row)
+
+    def items(self):
+        return zip(self.names, self.row)
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def copy(self):
+        return OrderedDict(self.items())
+
+
+Mapping.register(Record)
+
+
+class Schema(object):
+    """ Converters and record type derived from the header of the catalog """
+
+    def __init__(self, header):
+        self.header         = header
+        self.converters     = [text if name in text_columns else number for name in header]
+        self.date_column    = header.index('SceneDate')
+        self.record_type    = type('Record', (Record,), {
+            '__slots__':    (),
+            'names':        tuple(header),
+            'columns':      dict((name, i) for i, name in enumerate(header))
+        })
+
+    def record(self, row):
+        return self.record_type(tuple(convert(v) for convert, v in zip(self.converters, row)))
+
+
+def scene_date(row, column):
+    return convert_date(row[column].split(' ')[0])
+
+
+def build_date_index(fname, index_fname):
+    """ Scans the CSV once and saves, next to it, the byte ranges of each run of
+    consecutive rows sharing a SceneDate. Assumes one row per line """
+    runs = []
+    with open(fname, 'rb') as f:
+        header  = csv.reader([f.readline()]).next()
+        column  = header.index('SceneDate')
+        offset  = f.tell()
+        for line in iter(f.readline, ''):
+            date = scene_date(csv.reader([line]).next(), column).toordinal()
+            end  = offset + len(line)
+            if runs and runs[-1][0] == date:
+                runs[-1][2] = end
+            else:
+                runs.append([date, offset, end])
+            offset = end
+
+    stat  = os.stat(fname)
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime, 'runs': runs}
+    try:
+        with open(index_fname, 'w') as f:
+            json.dump(index, f)
+    except IOError as e:
+        logger.error('Could not save the date index %s: %s' % (index_fname, e))
+    return index
+
+
+def date_index(fname):
+    """ Date index of the CSV from its sidecar file, rebuilt when the CSV size or mtime changed """
+    index_fname = fname + '.idx'
+    stat        = os.stat(fname)
+
+    if os.path.isfile(index_fname):
+        try:
+            with open(index_fname) as f:
+                index = json.load(f)
+            if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+                return index
+        except (ValueError, KeyError):
+            pass
+
+    logger.info('Building date index %s' % index_fname)
+    return build_date_index(fname, index_fname)
+
+
+def indexed_rows(fname, start_date=None, end_date=None):
+    """ Rows dated between start_date and end_date, read by seeking to the matching runs of the date index """
+    start   = start_date.toordinal() if start_date else None
+    end     = end_date.toordinal() if end_date else None
+
+    # merge matching runs that follow each other in the file into single reads
+    ranges = []
+    for date, first, last in date_index(fname)['runs']:
+        if (start and date < start) or (end and date > end):
+            continue
+        if ranges and ranges[-1][1] == first:
+            ranges[-1][1] = last
+        else:
+            ranges.append([first, last])
+
+    with open(fname, 'rb') as f:
+        for first, last in ranges:
+            f.seek(first)
+            for row in csv.reader(f.read(last - first).splitlines(True)):
+                yield row
+
+
 def download_meta(url, download_path):
     dpath = download_path if download_path else mkdtemp()
     dpath = os.path.join(dpath, 'Hyperion.csv')
@@ -36,19 +218,132 @@ def download_meta(url, download_path):
     return open(dpath, 'r')
 
 
-def row_processor(record, date, dst, writers):
+class Pipeline(object):
+    """ Runs tasks on a pool of worker threads. submit() blocks while queue_size tasks are
+    waiting or running, so the producer never gets far ahead of the workers. A task that raises
+    is logged and counted without stopping the others, and a task running longer than timeout
+    seconds is reported as timed out and no longer waited for. Tasks raising throttle.Deferred
+    are kept aside and can be run again by join """
+
+    def __init__(self, workers, queue_size=None, timeout=None):
+        self.executor   = futures.ThreadPoolExecutor(max_workers=workers)
+        self.queue_size = queue_size or 2 * workers
+        self.timeout    = timeout
+        self.pending    = {}
+        self.deferred   = []
+        self.stats      = OrderedDict([('processed', 0), ('failed', 0), ('timed_out', 0), ('deferred', 0)])
+
+    def submit(self, name, fn, *args):
+        while len(self.pending) >= self.queue_size:
+            self.wait()
+
+        started = []
+
+        def task():
+            started.append(time.time())
+            return fn(*args)
+
+        self.pending[self.executor.submit(task)] = (name, started, fn, args)
+
+    def wait(self, timeout=1.0):
+        done, _ = futures.wait(list(self.pending), timeout=timeout, return_when=futures.FIRST_COMPLETED)
+
+        for f in done:
+            name, started, fn, args = self.pending.pop(f)
+            if f.cancelled():
+                continue
+            if isinstance(f.exception(), throttle.Deferred):
+                logger.info('%s deferred: %s' % (name, f.exception()))
+                self.deferred.append((name, fn, args))
+            elif f.exception() is not None:
+                logger.error('%s failed: %s' % (name, f.exception()))
+                self.stats['failed'] += 1
+            else:
+                self.stats['processed'] += 1
+
+        if self.timeout:
+            now = time.time()
+            for f, (name, started, fn, args) in list(self.pending.items()):
+                if started and now - started[0] > self.timeout:
+                    logger.error('%s timed out after %ds' % (name, self.timeout))
+                    self.stats['timed_out'] += 1
+                    del self.pending[f]
+
+    def drain(self):
+        while self.pending:
+            self.wait()
+
+    def join(self, retries=0, retry_delay=60):
+        """ Waits for the submitted tasks, then runs the deferred ones again, up to retries
+        rounds retry_delay seconds apart. On Ctrl-C the queued tasks are dropped and only
+        the running ones are waited for """
+        try:
+            self.drain()
+            for attempt in range(retries):
+                if not self.deferred:
+                    break
+                tasks, self.deferred = self.deferred, []
+                logger.info('retrying %d deferred scenes in %ds' % (len(tasks), retry_delay))
+                time.sleep(retry_delay)
+                for name, fn, args in tasks:
+                    self.submit(name, fn, *args)
+                self.drain()
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+        self.executor.shutdown(wait=False)
+
+        for name, fn, args in self.deferred:
+            logger.error('%s still deferred, left for a later run' % name)
+        self.stats['deferred'] = len(self.deferred)
+        return self.stats
+
+    def cancel(self):
+        logger.error('Interrupted, finishing the scenes in progress')
+        for f in list(self.pending):
+            f.cancel()
+        while self.pending:
+            self.wait()
+        self.executor.shutdown(wait=False)
+
+
+def row_processor(record, date, dst, writers, builder=None, journal=None):
 
     path = os.path.join(dst, str(date.year), date.strftime("%j"))
 
+    # skip the writers the journal says already completed this scene
+    if journal:
+        writers = [(name, w) for name, w in writers if not journal.completed(name, record['SceneName'])]
+        if not writers:
+            logger.info('skipping %s, already done' % record['SceneName'])
+            return
+
     logger.info('processing %s' % record['SceneName'])
-    for w in writers:
-        w(path, record)
+
+    # build the scene document once and hand the same result to every writer
+    with metrics.timed('scene'):
+        document = builder(record) if builder else record
+        for name, w in writers:
+            w(path, document)
 
 
 def csv_reader(fname, dst, writers, start_date=None, end_date=None, url=None,
-               download=False, download_path=None, num_worker_threads=1):
+               download=False, download_path=None, num_worker_threads=1, builder=None, row_timeout=None,
+               journal=None, use_index=False, subset=None, shard=None, retries=0, retry_delay=60,
+               prefetch=None, prefetch_size=512):
     """ Reads hyperion metadata from a csv file stored on USGS servers
-    and applys writer functions on the data """
+    and applys writer functions on the data, num_worker_threads rows at a time.
+    writers is a list of (name, function) pairs; with a journal, writers that already
+    completed a scene are not run again. With use_index, only the rows within the date range
+    are read, using a sidecar date index of the CSV.
+    subset (path, row, max_cloud) narrows the scenes further; it is applied in SQL
+    when fname is an SQLite catalog made by catalog.py.
+    shard is an optional (index, count, key) triple limiting the run to one shard of the scenes.
+    Scenes deferred because a service is unavailable are retried up to retries times.
+    prefetch, if given, is called with each batch of prefetch_size records still to process
+    before they are submitted, ie to resolve their lookups in bulk.
+    If a builder is given, it is called once per record and its result is passed to the writers.
+    Returns the counts of processed, failed and timed out rows """
 
     #if not url:
     #    url = 'https://landsat.usgs.gov/landsat/metadata_service/bulk_metadata_files/LANDSAT_8.csv'
@@ -67,8 +362,6 @@ def csv_reader(fname, dst, writers, start_date=None, end_date=None, url=None,
     #    r = requests.get(url, stream=True)
     #    liner = r.iter_lines
 	
-    liner = csv.reader(open(fname, 'rb'))
-    
     print start_date, end_date
     
     if start_date:
@@ -77,38 +370,76 @@ def csv_reader(fname, dst, writers, start_date=None, end_date=None, url=None,
     if end_date:
         end_date = convert_date(end_date)
 
-    header = None
+    filters = []
+    if catalog.is_catalog(fname):
+        header, liner = catalog.catalog_rows(fname, start_date, end_date, **(subset or {}))
+    else:
+        liner = csv.reader(open(fname, 'rb'))
+
+        # read the header
+        header = liner.next()
+        filters = subset_filters(header, **(subset or {}))
 
-    # read the header
-    header = liner.next()
+        if use_index and (start_date or end_date):
+            liner = indexed_rows(fname, start_date, end_date)
     
-    def gen(line):
-        row = line  #.split(',')
-        for j, v in enumerate(row):
-            try:
-                row[j] = float(v)
-            except ValueError:
-                pass
-
-        # generate the record
-        record = OrderedDict(zip(header, row))
-        date = convert_date(record['SceneDate'].split(' ')[0])
-
-        # apply filter
-        # if there is an enddate, stops the process when the end date is reached
+    schema  = Schema(header)
+    dates   = {}
+    names   = header.index('SceneName')
+    batch   = []
+
+    def pending(record):
+        # scenes every writer already completed need nothing fetched
+        return not journal or not all(journal.completed(name, record['SceneName']) for name, w in writers)
+
+    def submit():
+        # prefetch times itself, csv_submit measures the wait for room in the pipeline
+        if prefetch:
+            records = [record for record, date in batch if pending(record)]
+            if records:
+                prefetch(records)
+        with metrics.timed('csv_submit'):
+            for record, date in batch:
+                pipeline.submit(record['SceneName'], row_processor, record, date, dst, writers, builder, journal)
+        del batch[:]
+
+    def gen(row):
+        # apply filter on the raw date before converting the row
+        # many rows share a date, so parsed dates are memoized
+        raw = row[schema.date_column].split(' ')[0]
+        date = dates.get(raw)
+        if date is None:
+            date = dates[raw] = convert_date(raw)
+
         if end_date and date > end_date:
             return
 
         if start_date and date < start_date:
             return
 
-        row_processor(record, date, dst, writers)
+        for column, test in filters:
+            if not test(row[column]):
+                return
+
+        if shard and not sharding.selects(shard[0], shard[1], shard[2], row[names], date):
+            return
+
+        batch.append((schema.record(row), date))
+        return len(batch) >= (prefetch_size if prefetch else 1)
+
+    pipeline = Pipeline(num_worker_threads, timeout=row_timeout)
+    try:
+        for line in liner:
+            with metrics.timed('csv_row'):
+                full = gen(line)
+            if full:
+                submit()
+        submit()
+    except KeyboardInterrupt:
+        pipeline.cancel()
+        raise
 
-    for line in liner:
-        gen(line)
-        
-    #with futures.ThreadPoolExecutor(max_workers=num_worker_threads) as executor:
-    #    try:
-    #        executor.map(gen, liner, timeout=30)
-    #    except futures.TimeoutError:
-    #        print('skipped')
+    stats = pipeline.join(retries, retry_delay)
+    logger.info('%(processed)d scenes processed, %(failed)d failed, %(timed_out)d timed out, '
+                '%(deferred)d deferred' % stats)
+    return stats
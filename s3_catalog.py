@@ -0,0 +1,134 @@
+#
+# Per-day and per-year catalogs of the scenes published on S3, as gzip compressed NDJSON objects
+#
+import json, zlib, logging, threading
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+from concurrent import futures
+
+logger = logging.getLogger('hyperion.meta')
+
+
+def entry(body, href):
+    """ Catalog line of a scene document: id, date, bounding box, cloud cover and metadata href """
+    bbox        = None
+    geometry    = body.get('data_geometry')
+    if geometry:
+        points = [(float(lon), float(lat)) for lon, lat in geometry['coordinates'][0]
+                  if lon not in (None, '') and lat not in (None, '')]
+        if points:
+            lons, lats = zip(*points)
+            bbox = [min(lons), min(lats), max(lons), max(lats)]
+
+    return OrderedDict([
+        ('scene_id',        body['scene_id']),
+        ('date',            body['date']),
+        ('bbox',            bbox),
+        ('cloud_coverage',  body.get('cloud_coverage')),
+        ('href',            href)
+    ])
+
+
+def compress(text):
+    # zlib leaves the gzip header timestamp at 0, so the same catalog always has the same MD5
+    z = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return z.compress(text) + z.flush()
+
+
+class Catalogs(object):
+    """ Collects the catalog entries of the scenes stored during a run, by day. close() merges them
+    into the existing <prefix>/<year>/<doy>/catalog.ndjson.gz and <prefix>/<year>/catalog.ndjson.gz
+    objects, so each affected day and year is written once per run. Lines are sorted by scene id
+    and a scene written again replaces its line.
+    Concurrent runs must not update the same catalogs: the shards of a run save their entries
+    to a local file instead, and the process running them reads them back and writes the catalogs """
+
+    name = 'catalog.ndjson.gz'
+
+    def __init__(self, uploader, prefix='L1U', max_workers=16):
+        self.uploader       = uploader
+        self.prefix         = prefix
+        self.max_workers    = max_workers
+        self.lock           = threading.Lock()
+        self.days           = {}
+
+    def add(self, year, doy, entry):
+        with self.lock:
+            self.days.setdefault((year, doy), []).append(entry)
+
+    def save(self, path):
+        """ Writes the collected entries to a local NDJSON file instead of S3. Returns how many """
+        with self.lock:
+            days        = self.days
+            self.days   = {}
+
+        count = 0
+        with open(path, 'w') as f:
+            for (year, doy), entries in sorted(days.items()):
+                for e in entries:
+                    f.write(json.dumps([year, doy, e]) + '\n')
+                    count += 1
+        return count
+
+    def read(self, path):
+        """ Adds the entries saved by a shard """
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    year, doy, e = json.loads(line, object_pairs_hook=OrderedDict)
+                    self.add(year, doy, e)
+
+    def key(self, *parts):
+        return '/'.join((self.prefix,) + parts + (self.name,))
+
+    def load(self, key):
+        """ Lines of a stored catalog by scene id, empty if there is none yet """
+        try:
+            data = self.uploader.client.get_object(Bucket=self.uploader.bucket, Key=key)['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return {}
+            raise
+
+        lines = {}
+        for line in zlib.decompress(data, 16 + zlib.MAX_WBITS).splitlines():
+            if line:
+                lines[json.loads(line)['scene_id']] = line
+        return lines
+
+    def merge(self, key, entries):
+        lines = self.load(key)
+        for e in entries:
+            lines[e['scene_id']] = json.dumps(e, separators=(',', ':'))
+
+        text = ''.join(lines[scene_id] + '\n' for scene_id in sorted(lines))
+        if not self.uploader.upload(key, compress(text), content_type='application/gzip'):
+            raise IOError('upload failed')
+
+    def close(self):
+        """ Writes the catalogs of the affected days and years. Returns how many were stored """
+        with self.lock:
+            days        = self.days
+            self.days   = {}
+
+        years = {}
+        for (year, doy), entries in days.items():
+            years.setdefault(year, []).extend(entries)
+
+        merges  = [(self.key(year, doy), entries) for (year, doy), entries in sorted(days.items())]
+        merges += [(self.key(year), entries) for year, entries in sorted(years.items())]
+
+        executor = futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        results  = [executor.submit(self.merge, key, entries) for key, entries in merges]
+        executor.shutdown(wait=True)
+
+        stored = 0
+        for (key, entries), result in zip(merges, results):
+            if result.exception() is not None:
+                logger.error('S3 catalog %s not updated: %s', key, result.exception())
+            else:
+                stored += 1
+
+        logger.info('S3 catalogs updated for %d days and %d years, %d failed', len(days), len(years),
+                    len(merges) - stored)
+        return stored
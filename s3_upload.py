@@ -0,0 +1,95 @@
+#
+# Concurrent S3 uploads that skip objects whose content has not changed
+#
+import base64, hashlib, logging, threading
+import boto3
+
+from botocore.client import Config
+from botocore.exceptions import ClientError
+from concurrent import futures
+import metrics
+
+logger = logging.getLogger('hyperion.meta')
+
+
+class Uploader(object):
+    """ Uploads objects from a pool of max_workers threads sharing one connection pool.
+    An object is only PUT when the MD5 of the new body differs from the ETag already stored
+    under its key, or, when a content_hash is given, when it differs from the content-hash
+    metadata stored with the object. With skip_unchanged off every object is PUT without a check.
+    put() blocks once 2 * max_workers uploads are queued.
+    The on_done callback given with an object is called once the object is stored, or found unchanged """
+
+    def __init__(self, bucket, max_workers=16, acl='public-read', content_type='application/json',
+                 endpoint_url=None, skip_unchanged=True):
+        self.bucket         = bucket
+        self.acl            = acl
+        self.content_type   = content_type
+        self.skip_unchanged = skip_unchanged
+
+        session     = boto3.session.Session()
+        self.client = session.client('s3', endpoint_url=endpoint_url,
+                                     config=Config(max_pool_connections=max_workers))
+
+        self.lock       = threading.Lock()
+        self.slots      = threading.BoundedSemaphore(2 * max_workers)
+        self.executor   = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+        self.uploaded   = []
+        self.skipped    = []
+        self.failed     = []
+
+    def put(self, key, body, on_done=None, content_type=None, content_hash=None):
+        self.slots.acquire()
+        future = self.executor.submit(self.upload, key, body, on_done, content_type, content_hash)
+        future.add_done_callback(lambda f: self.slots.release())
+
+    def stored(self, key):
+        """ ETag and content-hash metadata of the stored object, or None if there is none """
+        try:
+            with metrics.timed('s3_head'):
+                head = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None, None
+            raise
+        return head['ETag'].strip('"'), head.get('Metadata', {}).get('content-hash')
+
+    def upload(self, key, body, on_done=None, content_type=None, content_hash=None):
+        """ Stores one object from the calling thread. Returns False if it could not be stored """
+        try:
+            digest          = hashlib.md5(body)
+            etag, stored    = self.stored(key) if self.skip_unchanged else (None, None)
+            if etag == digest.hexdigest() or content_hash and stored == content_hash:
+                self.done(self.skipped, key)
+                if on_done:
+                    on_done()
+                return True
+
+            metadata = {'content-hash': content_hash} if content_hash else {}
+            with metrics.timed('s3_put'):
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=body, ACL=self.acl, Metadata=metadata,
+                                       ContentType=content_type or self.content_type,
+                                       ContentMD5=base64.b64encode(digest.digest()))
+            metrics.written('s3_put', len(body))
+            logger.info('saving to s3 at %s %s', self.bucket, key)
+            self.done(self.uploaded, key)
+            if on_done:
+                on_done()
+            return True
+
+        except Exception as e:
+            logger.error('S3 upload failed %s: %s', key, e)
+            self.done(self.failed, key)
+            return False
+
+    def done(self, keys, key):
+        with self.lock:
+            keys.append(key)
+
+    def close(self):
+        """ Waits for the queued uploads and reports the totals """
+        self.executor.shutdown(wait=True)
+        logger.info('S3 uploads done: %d uploaded, %d skipped, %d failed',
+                    len(self.uploaded), len(self.skipped), len(self.failed))
+        return self.uploaded, self.skipped, self.failed
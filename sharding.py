@@ -0,0 +1,123 @@
+#
+# Splits a run into shards processed by separate processes or machines, and merges their reports
+#
+# python main.py es s3 --csv Hyperion.csv --shard 0/4 --report report.json
+# python sharding.py merge-reports report.0-of-4.json report.1-of-4.json ... --shards 4 -o report.json
+#
+import os, sys, json, zlib, subprocess, click
+from collections import OrderedDict
+
+
+def parse(spec):
+    """ Shard index and count from 'i/n', with 0 <= i < n """
+    try:
+        index, count = [int(v) for v in spec.split('/')]
+    except ValueError:
+        raise click.BadParameter('Shard must be i/n, ie 0/4 (%s)' % spec)
+    if count < 1 or not 0 <= index < count:
+        raise click.BadParameter('Shard index must be between 0 and n-1 (%s)' % spec)
+    return index, count
+
+
+def selects(index, count, key, scene_name, date):
+    """ True if a scene belongs to shard index of count. hash spreads scenes on a CRC32 of
+    their name, date keeps all the scenes of a day in the same shard """
+    if key == 'date':
+        return date.toordinal() % count == index
+    return (zlib.crc32(scene_name) & 0xffffffff) % count == index
+
+
+def part_name(index, count):
+    return '%d-of-%d' % (index, count)
+
+
+def part_path(path, index, count):
+    """ Per shard file name, ie journal.txt -> journal.2-of-4.txt """
+    root, ext = os.path.splitext(path)
+    return '%s.%s%s' % (root, part_name(index, count), ext)
+
+
+def without_option(argv, name):
+    """ Command line with an option and its value removed """
+    args = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == name:
+            skip = True
+        elif not arg.startswith(name + '='):
+            args.append(arg)
+    return args
+
+
+def launch(argv, processes):
+    """ Runs the command once per shard, adding --shard i/n, and returns the exit statuses """
+    children = [subprocess.Popen([sys.executable] + argv + ['--shard', '%d/%d' % (i, processes)])
+                for i in range(processes)]
+    return [child.wait() for child in children]
+
+
+def add(total, values):
+    for k, v in values.items():
+        if isinstance(v, dict):
+            add(total.setdefault(k, OrderedDict()), v)
+        else:
+            total[k] = total.get(k, 0) + v
+
+
+def merge(reports, count=None):
+    """ One summary of shard reports: counts are summed, seconds is the slowest shard,
+    and shards without a report are listed as missing. The shard count is taken from the
+    reports unless given, which lists every shard as missing when no report was written """
+    merged = OrderedDict([('shards', []), ('missing', []), ('seconds', 0), ('stats', OrderedDict()),
+                          ('writers', OrderedDict())])
+    for report in reports:
+        index, total = parse(report['shard'])
+        count = count or total
+        merged['shards'].append(report['shard'])
+        merged['seconds'] = max(merged['seconds'], report['seconds'])
+        add(merged['stats'], report['stats'])
+        add(merged['writers'], report['writers'])
+
+    if count:
+        seen = set(parse(s)[0] for s in merged['shards'])
+        merged['missing'] = ['%d/%d' % (i, count) for i in range(count) if i not in seen]
+    return merged
+
+
+def write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=4, separators=(',', ': '))
+
+
+def merge_files(paths, output, count=None):
+    """ Merges the reports that exist among paths into output """
+    reports = []
+    for path in paths:
+        if os.path.isfile(path):
+            with open(path) as f:
+                reports.append(json.load(f, object_pairs_hook=OrderedDict))
+    merged = merge(reports, count)
+    write_json(output, merged)
+    return merged
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command('merge-reports')
+@click.argument('reports', nargs=-1, required=True)
+@click.option('-o', '--output', default='hyperion-report.json', help='Merged report. Default=hyperion-report.json')
+@click.option('--shards', default=None, type=int,
+              help='Shards the run was split into. Default=the count found in the reports')
+def merge_reports_command(reports, output, shards):
+    """ Combines the reports of the shards of a run into one summary """
+    merged = merge_files(reports, output, shards)
+    print json.dumps(merged, indent=4, separators=(',', ': '))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,150 @@
+#
+# NDJSON shard output: compact scene documents appended to one file per year or per day
+#
+import os, zlib, threading
+from collections import OrderedDict
+
+
+class Shard(object):
+    """ One NDJSON file and its offset index. Documents are buffered into blocks;
+    compressed shards write each block as its own gzip member, so the file stays a
+    valid gzip stream and a document is read back by inflating a single block.
+
+    Each index line holds: scene_id, block offset, offset inside the block, length """
+
+    def __init__(self, path, compress):
+        self.path       = path
+        self.compress   = compress
+        self.offset     = os.path.getsize(path) if os.path.exists(path) else 0
+        self.data       = open(path, 'ab')
+        self.index      = open(path + '.idx', 'ab')
+        self.block      = []
+        self.size       = 0
+
+    def add(self, scene_id, text, on_done):
+        self.block.append((scene_id, text, on_done))
+        self.size += len(text) + 1
+
+    def flush(self):
+        if not self.block:
+            return
+
+        lines   = []
+        entries = []
+        inner   = 0
+        for scene_id, text, on_done in self.block:
+            lines.append(text + '\n')
+            entries.append('%s\t%d\t%d\t%d\n' % (scene_id, self.offset, inner, len(text)))
+            inner += len(text) + 1
+
+        payload = ''.join(lines)
+        if self.compress:
+            z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            payload = z.compress(payload) + z.flush()
+
+        self.data.write(payload)
+        self.data.flush()
+        self.index.write(''.join(entries))
+        self.index.flush()
+        self.offset += len(payload)
+
+        block = self.block
+        self.block  = []
+        self.size   = 0
+        for scene_id, text, on_done in block:
+            if on_done:
+                on_done()
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.index.close()
+
+
+class ShardWriter(object):
+    """ Appends documents to <folder>/<year>.ndjson or <folder>/<year>/<doy>.ndjson,
+    with a .gz suffix when compressed. on_done runs once the document's block is written.
+    Processes sharing a folder are given a distinct `part`, which is added to the file names.
+    Only the `max_open` most recently used shards are kept open """
+
+    def __init__(self, folder, granularity='year', compress=False, block_size=64 * 1024, max_open=32, part=None):
+        self.folder         = folder
+        self.part           = part
+        self.granularity    = granularity
+        self.compress       = compress
+        self.block_size     = block_size
+        self.max_open       = max_open
+        self.shards         = OrderedDict()
+        self.lock           = threading.Lock()
+        self.written        = 0
+
+    def shard_path(self, year, doy):
+        suffix = '.ndjson.gz' if self.compress else '.ndjson'
+        if self.part:
+            suffix = '.' + self.part + suffix
+        if self.granularity == 'day':
+            return os.path.join(self.folder, year, doy + suffix)
+        return os.path.join(self.folder, year + suffix)
+
+    def shard(self, path):
+        shard = self.shards.pop(path, None)
+        if shard is None:
+            if len(self.shards) >= self.max_open:
+                _, oldest = self.shards.popitem(last=False)
+                oldest.close()
+            folder = os.path.dirname(path)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            shard = Shard(path, self.compress)
+        self.shards[path] = shard
+        return shard
+
+    def add(self, year, doy, scene_id, text, on_done=None):
+        with self.lock:
+            shard = self.shard(self.shard_path(year, doy))
+            shard.add(scene_id, text, on_done)
+            self.written += 1
+            if shard.size >= self.block_size:
+                shard.flush()
+
+    def flush(self):
+        with self.lock:
+            for shard in self.shards.values():
+                shard.flush()
+
+    def close(self):
+        with self.lock:
+            for shard in self.shards.values():
+                shard.close()
+            self.shards.clear()
+        return self.written
+
+
+def read(path, scene_id):
+    """ Document of a scene read from a shard through its index, or None.
+    A scene written more than once resolves to its latest copy """
+    entry = None
+    with open(path + '.idx') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == scene_id:
+                entry = [int(v) for v in fields[1:]]
+
+    if entry is None:
+        return None
+
+    block, inner, length = entry
+    with open(path, 'rb') as f:
+        if not path.endswith('.gz'):
+            f.seek(block + inner)
+            return f.read(length)
+
+        f.seek(block)
+        z    = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = ''
+        while len(data) < inner + length and not z.unused_data:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            data += z.decompress(chunk)
+        return data[inner:inner + length]
@@ -0,0 +1,204 @@
+#
+# Rate limiting, retries and circuit breaking of the requests sent to external services
+#
+import time, socket, logging, threading, urllib2, httplib, requests
+import metrics
+
+logger = logging.getLogger('hyperion.meta')
+
+
+class Throttled(Exception):
+    """ The service refused the request for now, ie over its quota """
+
+
+class Deferred(Exception):
+    """ The service can not be used for now; the scene should be tried again later """
+
+
+class TokenBucket(object):
+    """ rate tokens per second, up to capacity. Tokens are reserved ahead, so concurrent
+    callers are spaced out instead of all waking up at once """
+
+    def __init__(self, rate, capacity):
+        self.rate       = float(rate)
+        self.capacity   = float(capacity)
+        self.tokens     = self.capacity
+        self.stamp      = time.time()
+
+    def reserve(self, now):
+        """ Takes a token and returns the seconds to wait before it is available """
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp  = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def cancel(self):
+        self.tokens += 1
+
+
+def status(e):
+    """ HTTP status of an error answer, or None """
+    if isinstance(e, urllib2.HTTPError):
+        return e.code
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code
+    return None
+
+
+def retryable(e):
+    """ True for errors worth trying again: throttling, server errors and network failures """
+    code = status(e)
+    if code is not None:
+        return code == 429 or code >= 500
+    return isinstance(e, (Throttled, requests.RequestException, urllib2.URLError, socket.error,
+                          httplib.HTTPException))
+
+
+def throttling(e):
+    return isinstance(e, Throttled) or status(e) in (429, 503)
+
+
+class Limiter(object):
+    """ Shared by every request to one service. Requests are spaced by token buckets for the
+    per second rate and the hourly and daily quotas. Throttling responses double a pause applied to
+    all the requests, which halves again on each success. Failed requests are retried with
+    exponential backoff; after `threshold` consecutive failures the circuit opens and requests
+    raise Deferred for `cooldown` seconds, after which a single trial request decides whether
+    it closes again. A request that would wait longer than max_wait is deferred as well.
+    With a `state` cache, the tokens left are saved under `key` every save_interval seconds and
+    restored by the next run, so quotas are not refilled by restarting """
+
+    def __init__(self, name, rate=None, per_hour=None, per_day=None, retries=4, backoff=1.0, max_backoff=300.0,
+                 threshold=5, cooldown=60.0, max_wait=60.0, state=None, key=None, save_interval=10.0):
+        self.name           = name
+        self.buckets        = []
+        self.retries        = retries
+        self.backoff        = backoff
+        self.max_backoff    = max_backoff
+        self.threshold      = threshold
+        self.cooldown       = cooldown
+        self.max_wait       = max_wait
+        self.lock           = threading.Lock()
+        self.pause          = 0.0
+        self.paused_until   = 0.0
+        self.failures       = 0
+        self.opened         = None
+        self.probing        = False
+        self.state          = state
+        self.key            = key or name
+        self.save_interval  = save_interval
+        self.saved          = 0.0
+
+        if rate:
+            self.buckets.append(TokenBucket(rate, max(1.0, rate)))
+        if per_hour:
+            self.buckets.append(TokenBucket(per_hour / 3600.0, per_hour))
+        if per_day:
+            self.buckets.append(TokenBucket(per_day / 86400.0, per_day))
+
+        saved = state.get(self.key) if state else None
+        if saved and len(saved) == len(self.buckets):
+            for bucket, (tokens, stamp) in zip(self.buckets, saved):
+                bucket.tokens   = min(bucket.capacity, tokens)
+                bucket.stamp    = stamp
+
+    def save(self):
+        """ Stores the tokens left in each bucket """
+        if self.state:
+            with self.lock:
+                buckets     = [[bucket.tokens, bucket.stamp] for bucket in self.buckets]
+                self.saved  = time.time()
+            self.state.set(self.key, buckets)
+
+    def admit(self):
+        """ Waits for the turn of a request, or raises Deferred """
+        with self.lock:
+            now = time.time()
+            if self.opened is not None:
+                if now - self.opened < self.cooldown or self.probing:
+                    metrics.count(self.name + '_deferred')
+                    raise Deferred('%s unavailable, circuit open' % self.name)
+                self.probing = True
+
+            waits = [bucket.reserve(now) for bucket in self.buckets]
+            wait  = max(waits + [self.paused_until - now, 0.0])
+            if wait > self.max_wait:
+                for bucket in self.buckets:
+                    bucket.cancel()
+                self.probing = False
+                metrics.count(self.name + '_deferred')
+                raise Deferred('%s quota exhausted for the next %ds' % (self.name, wait))
+            due = self.state is not None and now - self.saved >= self.save_interval
+
+        if due:
+            self.save()
+
+        if wait > 0:
+            metrics.count(self.name + '_waits')
+            time.sleep(wait)
+
+    def succeeded(self):
+        with self.lock:
+            if self.opened is not None:
+                logger.info('%s circuit closed' % self.name)
+            self.failures   = 0
+            self.opened     = None
+            self.probing    = False
+            self.pause      = self.pause / 2 if self.pause >= 2 * self.backoff else 0.0
+
+    def failed(self, throttled):
+        with self.lock:
+            self.failures += 1
+            if throttled:
+                metrics.count(self.name + '_throttled')
+                self.pause          = min(self.max_backoff, max(self.backoff, self.pause * 2))
+                self.paused_until   = time.time() + self.pause
+            if self.probing or (self.opened is None and self.failures >= self.threshold):
+                logger.error('%s circuit open for %ds after %d failures' % (self.name, self.cooldown, self.failures))
+                metrics.count(self.name + '_circuit_open')
+                self.opened = time.time()
+            self.probing = False
+
+    def call(self, fn, *args):
+        """ fn(*args) within the limits of the service """
+        attempt = 0
+        while True:
+            self.admit()
+            try:
+                result = fn(*args)
+            except Exception as e:
+                if not retryable(e):
+                    with self.lock:
+                        self.probing = False
+                    raise
+                self.failed(throttling(e))
+                attempt += 1
+                if attempt > self.retries:
+                    raise Deferred('%s failed %d times: %s' % (self.name, attempt, e))
+                logger.info('%s request failed (%s), retrying' % (self.name, e))
+                if not throttling(e):
+                    time.sleep(min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+                continue
+
+            self.succeeded()
+            return result
+
+
+limiters = {}
+
+
+def configure(name, **options):
+    limiters[name] = Limiter(name, **options)
+
+
+def save():
+    """ Stores the state of every limiter, ie at the end of a run """
+    for l in limiters.values():
+        l.save()
+
+
+def limiter(name):
+    """ Limiter of a service, unlimited until configured """
+    if name not in limiters:
+        limiters[name] = Limiter(name)
+    return limiters[name]
@@ -0,0 +1,40 @@
+#
+# Shared HTTP client: pooled keep-alive connections to the web services
+#
+import threading, requests
+from requests.adapters import HTTPAdapter
+
+pool_size   = 20
+timeout     = (10, 30)
+
+session     = None
+lock        = threading.Lock()
+
+
+def configure(connections=20, connect_timeout=10, read_timeout=30):
+    """ connections kept open per host, which should cover the threads calling it """
+    global pool_size, timeout, session
+    pool_size   = connections
+    timeout     = (connect_timeout, read_timeout)
+    session     = None
+
+
+def get_session():
+    """ Session shared by every thread. Connections are reused across requests
+    and gzip/deflate answers are decompressed by requests """
+    global session
+    with lock:
+        if session is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size, max_retries=0)
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            session = s
+        return session
+
+
+def get_json(url, params=None):
+    """ Decoded JSON answer of a GET, raising requests.HTTPError on error statuses """
+    response = get_session().get(url, params=params, timeout=timeout)
+    response.raise_for_status()
+    return response.json()